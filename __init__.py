@@ -2,8 +2,12 @@ from trytond.pool import Pool
 from .encounter_component_type import EncounterComponentType
 from .encounter import PatientEncounter
 from .components import *
-from .appointment import CreateAppointmentEncounter
+from .appointment import (CreateAppointmentEncounter, BatchEncounterStart,
+                          CreateBatchEncounters)
 from .reports import EncounterReport
+from .company import Company
+from .healthprof import Party, HealthProfessional
+from .access import ModelAccess, ModelFieldAccess
 
 def register():
     """Register models to tryton's pool"""
@@ -22,11 +26,18 @@ def register():
         SignsAndSymptoms,
         EncounterComponent,
         ChooseComponentTypeView,
+        BatchEncounterStart,
+        Company,
+        Party,
+        HealthProfessional,
+        ModelAccess,
+        ModelFieldAccess,
         module='health_encounter', type_='model')
 
     Pool.register(
         EditComponentWizard,
         CreateAppointmentEncounter,
+        CreateBatchEncounters,
         module='health_encounter', type_='wizard')
 
     Pool.register(
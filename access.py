@@ -0,0 +1,33 @@
+from trytond.model import ModelSQL
+from . import utils
+
+__all__ = ['ModelAccess', 'ModelFieldAccess']
+
+
+class AccessCacheMixin(ModelSQL):
+    '''clears the cached access of the encounter models whenever an
+    access rule is changed'''
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(AccessCacheMixin, cls).create(vlist)
+        utils.clear_access_cache()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(AccessCacheMixin, cls).write(*args)
+        utils.clear_access_cache()
+
+    @classmethod
+    def delete(cls, records):
+        super(AccessCacheMixin, cls).delete(records)
+        utils.clear_access_cache()
+
+
+class ModelAccess(AccessCacheMixin):
+    __name__ = 'ir.model.access'
+
+
+class ModelFieldAccess(AccessCacheMixin):
+    __name__ = 'ir.model.field.access'
@@ -1,2 +1,3 @@
 
-from .wizard import CreateAppointmentEncounter
+from .wizard import (CreateAppointmentEncounter, BatchEncounterStart,
+                     CreateBatchEncounters)
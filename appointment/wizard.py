@@ -1,8 +1,16 @@
-# from trytond.model import ModelView, fields
-from trytond.wizard import (Wizard, StateAction)
+from datetime import datetime, date, time, timedelta
+import pytz
+from trytond.model import ModelView, fields
+from trytond.wizard import (Wizard, StateAction, StateView, Button)
 from trytond.transaction import Transaction
 from trytond.pool import Pool
 from trytond.pyson import PYSONEncoder
+from trytond.modules.health import HealthInstitution
+from .. import utils
+
+# appointments in these states do not get an encounter made in advance
+CLOSED_APPOINTMENT_STATES = ['free', 'done', 'user_cancelled',
+                             'center_cancelled', 'no_show']
 
 
 class OneAppointmentWizard(Wizard):
@@ -81,3 +89,87 @@ class CreateAppointmentEncounter(OneAppointmentWizard):
             })
 
         return action, rd
+
+
+class BatchEncounterStart(ModelView):
+    'Create Encounters for a Day'
+    __name__ = 'gnuhealth.appointment.encounter_batch.start'
+    institution = fields.Many2One('gnuhealth.institution', 'Institution',
+                                  required=True)
+    appointment_date = fields.Date('Date', required=True)
+
+    @staticmethod
+    def default_institution():
+        return HealthInstitution().get_institution()
+
+    @staticmethod
+    def default_appointment_date():
+        return date.today()
+
+
+class CreateBatchEncounters(Wizard):
+    '''Creates the encounters for all the appointments at an institution
+    on a day that do not have one yet'''
+    __name__ = 'gnuhealth.appointment.encounter_batch'
+
+    start = StateView(
+        'gnuhealth.appointment.encounter_batch.start',
+        'health_encounter.view_appointment_encounter_batch_start', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Create', 'open_', 'tryton-ok', default=True)
+        ])
+    open_ = StateAction('health_encounter.actwin_appt_encounter')
+
+    @classmethod
+    def __setup__(cls):
+        super(CreateBatchEncounters, cls).__setup__()
+        cls._error_messages.update({
+            'no_appointments': 'All the appointments at %(institution)s on '
+            '%(date)s already have an encounter.',
+        })
+
+    @classmethod
+    def get_day_bounds(cls, day):
+        '''returns the start and end, in UTC, of :param day: in the
+        timezone of the company'''
+        timezone = utils.get_timezone()
+        bounds = []
+        for bound in (day, day + timedelta(days=1)):
+            local = timezone.localize(datetime.combine(bound, time.min))
+            bounds.append(local.astimezone(pytz.utc).replace(tzinfo=None))
+        return bounds
+
+    def do_open_(self, action):
+        pool = Pool()
+        Appointment = pool.get('gnuhealth.appointment')
+        Encounter = pool.get('gnuhealth.encounter')
+        encounter = Encounter.__table__()
+        day_start, day_end = self.get_day_bounds(self.start.appointment_date)
+
+        appointments = Appointment.search([
+            ('institution', '=', self.start.institution.id),
+            ('appointment_date', '>=', day_start),
+            ('appointment_date', '<', day_end),
+            ('patient', '!=', None),
+            ('state', 'not in', CLOSED_APPOINTMENT_STATES),
+            ('id', 'not in', encounter.select(
+                encounter.appointment,
+                where=encounter.appointment != None)),
+        ], order=[('appointment_date', 'ASC')])
+        if not appointments:
+            self.raise_user_error('no_appointments', {
+                'institution': self.start.institution.rec_name,
+                'date': self.start.appointment_date.strftime('%Y-%m-%d')})
+
+        # create marks all the appointments as processing with one write.
+        # The encounters start at their appointment, on the chosen day
+        encounters = Encounter.create([{
+            'patient': x.patient.id,
+            'institution': x.institution.id,
+            'appointment': x.id,
+            'start_time': x.appointment_date,
+        } for x in appointments])
+
+        action['pyson_domain'] = PYSONEncoder().encode([
+            ('id', 'in', map(int, encounters))])
+        return action, {}
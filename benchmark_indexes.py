@@ -0,0 +1,199 @@
+# Seeds synthetic encounters and components and prints the query plans
+# of the hot encounter lookups without and with the module's indexes.
+# Everything is rolled back at the end
+import sys
+import time
+import random
+from datetime import datetime, timedelta
+
+from maintenance import start_pool
+
+SEED_CHUNK = 1000
+
+# model name => the columns indexed with select=True that are benchmarked
+SELECT_INDEXES = {
+    'gnuhealth.encounter': ['patient', 'institution', 'state',
+                            'appointment'],
+    'gnuhealth.secondary_condition': ['clinical_component'],
+    'gnuhealth.diagnostic_hypothesis': ['clinical_component'],
+    'gnuhealth.signs_and_symptoms': ['clinical_component'],
+    'gnuhealth.directions': ['encounter_component'],
+}
+
+
+def seed(pool, count):
+    '''inserts :param count: encounters for existing patients and
+    institutions and one ambulatory component for each of them. Returns
+    a sample patient, institution and encounter id'''
+    from sql import Literal
+    from sql.functions import CurrentTimestamp
+    from trytond.transaction import Transaction
+    cursor = Transaction().cursor
+    Encounter = pool.get('gnuhealth.encounter')
+    Patient = pool.get('gnuhealth.patient')
+    Institution = pool.get('gnuhealth.institution')
+    Ambulatory = pool.get('gnuhealth.encounter.ambulatory')
+    encounter = Encounter.__table__()
+    ambulatory = Ambulatory.__table__()
+
+    patients = map(int, Patient.search([], limit=500))
+    institutions = map(int, Institution.search([]))
+    if not patients or not institutions:
+        print 'At least one patient and one institution are needed'
+        sys.exit(1)
+
+    cursor.execute(*encounter.select(encounter.id, order_by=encounter.id.desc,
+                                     limit=1))
+    row = cursor.fetchone()
+    last_id = row and row[0] or 0
+    now = datetime.now()
+    states = ['signed'] * 8 + ['done', 'in_progress']
+    columns = [encounter.patient, encounter.institution, encounter.state,
+               encounter.start_time, encounter.active, encounter.create_uid,
+               encounter.create_date]
+    for i in range(0, count, SEED_CHUNK):
+        values = []
+        for _ in range(min(SEED_CHUNK, count - i)):
+            start = now - timedelta(minutes=random.randint(0, 2 * 525600))
+            values.append([random.choice(patients),
+                           random.choice(institutions),
+                           random.choice(states), start, True, 0, now])
+        cursor.execute(*encounter.insert(columns, values))
+
+    cursor.execute(*ambulatory.insert(
+        [ambulatory.encounter, ambulatory.start_time, ambulatory.active,
+         ambulatory.create_uid, ambulatory.create_date],
+        encounter.select(encounter.id, encounter.start_time, Literal(True),
+                         Literal(0), CurrentTimestamp(),
+                         where=encounter.id > last_id)))
+    cursor.execute(*encounter.select(
+        encounter.id, where=encounter.id > last_id,
+        order_by=encounter.id.desc, limit=1))
+    sample_id, = cursor.fetchone()
+    return random.choice(patients), random.choice(institutions), sample_id
+
+
+def get_queries(pool, patient, institution, encounter_id):
+    '''returns a list of (label, python-sql query) of the hot lookups'''
+    from sql import Literal
+    Encounter = pool.get('gnuhealth.encounter')
+    EncounterComponent = pool.get('gnuhealth.encounter.component')
+    encounter = Encounter.__table__()
+    queries = [
+        ('appointment lookup', encounter.select(
+            encounter.id, where=encounter.appointment == Literal(-1))),
+        ('patient history', encounter.select(
+            encounter.id, where=encounter.patient == patient,
+            order_by=encounter.start_time.desc, limit=50)),
+        ('clinic queue', encounter.select(
+            encounter.id,
+            where=((encounter.institution == institution)
+                   & (encounter.state == 'in_progress')),
+            order_by=encounter.start_time.asc)),
+        ('stale encounters', encounter.select(
+            encounter.id,
+            where=((encounter.state == 'in_progress')
+                   & (encounter.start_time
+                      < datetime.now() - timedelta(days=1))))),
+        ('components of an encounter', EncounterComponent.union_select(
+            ['id', 'start_time'],
+            where=lambda t: (t.encounter == encounter_id)
+            & (t.active == True))),
+        ('unsigned components', EncounterComponent.union_select(
+            ['encounter'],
+            where=lambda t: (t.encounter == encounter_id)
+            & (t.active == True) & (t.signed_by == None))),
+    ]
+    for model_name, columns in SELECT_INDEXES.items():
+        if model_name == 'gnuhealth.encounter':
+            continue
+        table = pool.get(model_name).__table__()
+        column = getattr(table, columns[0])
+        queries.append(('%s by %s' % (model_name, columns[0]),
+                        table.select(table.id, where=column == encounter_id)))
+    return queries
+
+
+def explain(queries):
+    '''prints the scan nodes and execution time of each query'''
+    from trytond.transaction import Transaction
+    cursor = Transaction().cursor
+    for label, query in queries:
+        sql, params = tuple(query)
+        cursor.execute('EXPLAIN ANALYZE ' + sql, params)
+        plan = [x for x, in cursor.fetchall()]
+        scans = sorted(set([line.strip().lstrip('-> ').split(' on ')[0]
+                            for line in plan if ' on ' in line
+                            and 'Scan' in line]))
+        timing = [x for x in plan if x.startswith('Execution time')
+                  or x.startswith('Total runtime')]
+        print '  %-45s %-20s %s' % (label, ', '.join(scans),
+                                    timing and timing[0] or '')
+
+
+def set_indexes(pool, action):
+    '''adds or removes the indexes created by the module'''
+    from trytond import backend
+    from trytond.transaction import Transaction
+    import indexes
+    cursor = Transaction().cursor
+    TableHandler = backend.get('TableHandler')
+    EncounterComponent = pool.get('gnuhealth.encounter.component')
+    component_models = EncounterComponent.union_models()
+    selects = dict(SELECT_INDEXES)
+    for model_name in component_models:
+        selects[model_name] = ['encounter']
+    for model_name, columns in selects.items():
+        Model = pool.get(model_name)
+        table = TableHandler(cursor, Model)
+        for column in columns:
+            table.index_action(column, action=action)
+    specs = [('gnuhealth_encounter', indexes.ENCOUNTER_INDEXES)]
+    specs.extend([(pool.get(x)._table, indexes.COMPONENT_INDEXES)
+                  for x in component_models])
+    for table_name, spec in specs:
+        if action == 'add':
+            indexes.create_indexes(table_name, spec)
+        else:
+            indexes.drop_indexes(table_name, spec)
+    cursor.execute('ANALYZE')
+
+
+def benchmark(dbname, conffile, count=100000):
+    from trytond.transaction import Transaction
+    pool = start_pool(dbname, conffile)
+    with Transaction().start(dbname, 0, context={}):
+        start = time.time()
+        sample = seed(pool, count)
+        print 'Seeded %d encounters in %.1fs' % (count, time.time() - start)
+        queries = get_queries(pool, *sample)
+        try:
+            set_indexes(pool, 'remove')
+            print 'Before:'
+            explain(queries)
+            set_indexes(pool, 'add')
+            print 'After:'
+            explain(queries)
+        finally:
+            Transaction().cursor.rollback()
+
+
+usage = """
+%s <config_file> <database_name> [<encounters>]
+
+Seeds synthetic encounters and prints the query plans of the hot
+encounter lookups without and with the health_encounter indexes.
+Nothing is committed.
+
+<config_file> = full path to trytond.conf
+<database_name> = name of database
+<encounters> = number of encounters to seed, default 100000
+"""
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print usage % sys.argv[0]
+    else:
+        args = sys.argv[1:3] + map(int, sys.argv[3:4])
+        benchmark(args[1], args[0], *args[2:])
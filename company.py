@@ -0,0 +1,17 @@
+from trytond.model import ModelSQL
+from . import utils
+
+__all__ = ['Company']
+
+
+class Company(ModelSQL):
+    __name__ = 'company.company'
+
+    @classmethod
+    def write(cls, *args):
+        super(Company, cls).write(*args)
+        actions = iter(args)
+        for companies, values in zip(actions, actions):
+            if 'timezone' in values:
+                utils.clear_timezone_cache()
+                break
@@ -1,14 +1,29 @@
 from datetime import datetime
+from threading import Lock
+from sql import Column, Union
+from trytond.cache import LRUDict
+from trytond.config import config
 from trytond.model import ModelView, ModelSQL, fields, UnionMixin
 from trytond.pyson import Eval, Bool, Not
 from trytond.pool import Pool
+from trytond.transaction import Transaction
 from .. import utils
+from .. import indexes
 from ..encounter_component_type import EncounterComponentType
 
 
 SIGNED_STATES = {'readonly': Bool(Eval('signed_by'))}
 SIGNED_VISIBLE = {'invisible': Not(Bool(Eval('signed_by')))}
 
+# rendered report_info of the components read in this process.
+# (database, model, id) => (write_date, {language: text}), the text has
+# the translated names of the related records
+_report_info_cache = LRUDict(
+    config.getint('health_encounter', 'report_info_cache_size',
+                  default=2048))
+# the server threads share the cache, LRUDict reorders itself on reads
+_report_info_lock = Lock()
+
 
 class BaseComponent(ModelSQL, ModelView):
     '''All components should inherit from this class. It's not a real
@@ -16,7 +31,7 @@ class BaseComponent(ModelSQL, ModelView):
     needed for a model to be a valid component. '''
     active = fields.Boolean('Active', select=True)
     encounter = fields.Many2One('gnuhealth.encounter', 'Encounter',
-                                readonly=True, required=True)
+                                readonly=True, required=True, select=True)
     start_time = fields.DateTime('Start', required=True, states=SIGNED_STATES)
     end_time = fields.DateTime('Finish', states=SIGNED_STATES)
     sign_time = fields.DateTime('Signed', readonly=True, states=SIGNED_VISIBLE)
@@ -32,7 +47,8 @@ class BaseComponent(ModelSQL, ModelView):
     notes = fields.Text('Notes', states=SIGNED_STATES)
     critical_info = fields.Char('Summary', readonly=True,
                                 depends=['notes'])
-    report_info = fields.Function(fields.Text('Report'), 'get_report_info')
+    report_info = fields.Function(fields.Text('Report'),
+                                  'get_cached_report_info')
     is_union_comp = fields.Function(fields.Boolean('Unified component'),
                                     'get_is_union')
     byline = fields.Function(fields.Char('Byline',
@@ -45,15 +61,23 @@ class BaseComponent(ModelSQL, ModelView):
         cls._order = [('start_time', 'ASC')]
         cls._order_name = 'start_time'
         cls.critical_info.depends = cls.get_critical_info_fields()
-        cls._error_messages = {
+        cls._error_messages.update({
             'bad_start_time': 'Component cannot start before the encounter',
-            'bad_end_time': 'End time cannot be before start time'
-        }
+            'bad_end_time': 'End time cannot be before start time',
+            'bad_component_times': 'These components have bad times:\n'
+            '%(components)s',
+            'health_professional_warning': 'No health professional '
+            'associated with this user'
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(BaseComponent, cls).__register__(module_name)
+        indexes.create_indexes(cls._table, indexes.COMPONENT_INDEXES)
 
     @staticmethod
     def default_performed_by():
-        HealthProfessional = Pool().get('gnuhealth.healthprofessional')
-        return HealthProfessional.get_health_professional()
+        return utils.get_health_professional()
 
     @staticmethod
     def default_active():
@@ -77,17 +101,107 @@ class BaseComponent(ModelSQL, ModelView):
         # no length limit
         return ""
 
+    @classmethod
+    def get_cached_report_info(cls, instances, name):
+        '''returns the text made by get_report_info for each instance.
+        The text is kept in the process, for each language, until the
+        component is written'''
+        transaction = Transaction()
+        database = transaction.cursor.database_name
+        language = transaction.language
+        result = {}
+        for instance in instances:
+            key = (database, cls.__name__, instance.id)
+            stamp = instance.write_date or instance.create_date
+            with _report_info_lock:
+                cached = _report_info_cache.get(key)
+            if cached and cached[0] == stamp and language in cached[1]:
+                result[instance.id] = cached[1][language]
+                continue
+            result[instance.id] = instance.get_report_info(name)
+            with _report_info_lock:
+                cached = _report_info_cache.get(key)
+                if not cached or cached[0] != stamp:
+                    cached = _report_info_cache[key] = (stamp, {})
+                cached[1][language] = result[instance.id]
+        return result
+
+    @classmethod
+    def clear_report_info(cls, ids):
+        database = Transaction().cursor.database_name
+        with _report_info_lock:
+            for component_id in ids:
+                _report_info_cache.pop(
+                    (database, cls.__name__, component_id), None)
+
+    @classmethod
+    def make_critical_infos(cls, records):
+        '''returns a dict of id => make_critical_info() for :param records:.
+        Components that summarise related records override it to read them
+        for all the records at once'''
+        return dict((r.id, r.make_critical_info()) for r in records)
+
+    @classmethod
+    def update_critical_info(cls, records):
+        '''recomputes critical_info for :param records: and stores the
+        values that changed using one UPDATE for each distinct value'''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        records = cls.browse(map(int, records))
+        values = cls.make_critical_infos(records)
+        ids_by_value = {}
+        for record in records:
+            value = values[record.id]
+            if value != record.critical_info:
+                ids_by_value.setdefault(value, []).append(record.id)
+        for value, ids in ids_by_value.items():
+            for i in range(0, len(ids), cursor.IN_MAX):
+                sub_ids = ids[i:i + cursor.IN_MAX]
+                cursor.execute(*table.update(
+                    [table.critical_info], [value],
+                    where=table.id.in_(sub_ids)))
+        return sum(map(len, ids_by_value.values()))
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(BaseComponent, cls).create(vlist)
+        cls.update_critical_info(records)
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        written = [x for records, _ in zip(actions, actions) for x in records]
+        cls.clear_report_info(map(int, written))
+        super(BaseComponent, cls).write(*args)
+        cls.update_critical_info(written)
+
+    @classmethod
+    def delete(cls, records):
+        cls.clear_report_info(map(int, records))
+        super(BaseComponent, cls).delete(records)
+
     def get_is_union(self, name):
         return False
 
     @classmethod
     def pre_sign(cls, components):
-        '''sets the healthprof and the sign_time for the current instance'''
-        health_prof_model = Pool().get('gnuhealth.healthprofessional')
-        signtime = datetime.now()
-        for comp in components:
-            comp.signed_by = health_prof_model.get_health_professional()
-            comp.sign_time = signtime
+        '''signs the :param components: as the current health professional,
+        same as sign_components'''
+        cls.sign_components(components)
+
+    @classmethod
+    @ModelView.button
+    def sign_components(cls, components):
+        '''signs the components that are not signed yet as the current
+        health professional using a single write'''
+        signing_hp = utils.get_health_professional()
+        if not signing_hp:
+            cls.raise_user_error('health_professional_warning')
+        unsigned = [x for x in components if not x.signed_by]
+        if unsigned:
+            cls.write(unsigned, {'signed_by': signing_hp,
+                                 'sign_time': datetime.now()})
 
     def pre_save(self):
         self.critical_info = self.make_critical_info()
@@ -120,12 +234,31 @@ class BaseComponent(ModelSQL, ModelView):
 
     @classmethod
     def validate(cls, records):
+        '''checks the times of all the records at once. The start times of
+        the encounters are read together and every component with bad
+        times is listed in a single error'''
+        Encounter = Pool().get('gnuhealth.encounter')
+        encounter_ids = list(set([rec.encounter.id for rec in records]))
+        encounter_starts = dict([
+            (x['id'], x['start_time'])
+            for x in Encounter.read(encounter_ids, ['start_time'])])
+        errors = []
         for rec in records:
             # start time can't be before encounter start time
-            if rec.start_time < rec.encounter.start_time:
-                cls.raise_user_error('bad_start_time')
+            if rec.start_time < encounter_starts[rec.encounter.id]:
+                errors.append((rec, 'bad_start_time'))
             if rec.end_time and rec.end_time < rec.start_time:
-                cls.raise_user_error('bad_end_time')
+                errors.append((rec, 'bad_end_time'))
+        if errors:
+            # each line gets the translated message of its error
+            messages = dict([(key, cls.raise_user_error(
+                key, raise_exception=False)) for _, key in errors])
+            cls.raise_user_error('bad_component_times', {
+                'components': u'\n'.join([
+                    u'EV%05d %s: %s' % (rec.encounter.id,
+                                        rec.start_time.strftime('%c'),
+                                        messages[key])
+                    for rec, key in errors])})
 
 
 class EncounterComponent(UnionMixin, BaseComponent):
@@ -134,7 +267,7 @@ class EncounterComponent(UnionMixin, BaseComponent):
     encounter points its One2Many field. '''
     __name__ = 'gnuhealth.encounter.component'
     component_type = fields.Function(fields.Char('Type'),
-                                     'get_component_type_name')
+                                     'get_union_type_info')
     start_time_time = fields.Function(fields.Time('Start', format='%H:%M'),
                                       'get_start_time_time')
 
@@ -148,6 +281,9 @@ class EncounterComponent(UnionMixin, BaseComponent):
             cls._buttons = {}
 
         cls._buttons['btn_open'] = {'readonly': Eval(False)}
+        cls._buttons['sign_components'] = {
+            'invisible': Bool(Eval('signed_by'))}
+        cls.is_union_comp.getter = 'get_union_type_info'
 
     @classmethod
     def __register__(cls, module_name):
@@ -160,23 +296,106 @@ class EncounterComponent(UnionMixin, BaseComponent):
         thelist = EncounterComponentType.get_selection_list()
         return [x[3] for x in thelist]
 
+    @classmethod
+    def union_unshard_many(cls, union_ids, grouped=False):
+        '''returns the real component instances for a list of union ids.
+        Each underlying model is browsed once for all its ids.
+
+        By default the instances are returned in the same order as
+        :param union_ids:. If :param grouped: is True, a dict of
+        model name => list of instances is returned instead.
+        '''
+        pool = Pool()
+        models = cls.union_models()
+        model_count = len(models)
+        positions = {}
+        for position, union_id in enumerate(map(int, union_ids)):
+            real_id, model_index = divmod(union_id, model_count)
+            positions.setdefault(models[model_index], []).append(
+                (position, real_id))
+
+        by_model = {}
+        instances = [None] * len(union_ids)
+        for model_name, pos_ids in positions.items():
+            Model = pool.get(model_name)
+            records = Model.browse([x for _, x in pos_ids])
+            by_model[model_name] = records
+            for (position, _), record in zip(pos_ids, records):
+                instances[position] = record
+        if grouped:
+            return by_model
+        return instances
+
+    @classmethod
+    def union_select(cls, column_names, where=None):
+        '''returns a SQL query that selects :param column_names: from
+        every component table. :param where: is an optional callable that
+        takes the table of each component model and returns the
+        condition to apply to it'''
+        pool = Pool()
+        query = None
+        for model_name in cls.union_models():
+            table = pool.get(model_name).__table__()
+            columns = [Column(table, x).as_(x) for x in column_names]
+            condition = where(table) if where else None
+            select = table.select(*columns, where=condition)
+            if query is None:
+                query = select
+            else:
+                query = Union(query, select, all_=True)
+        return query
+
     @classmethod
     def get_start_time_time(cls, instances, name):
         # return self.start_time.strftime('%H:%M')
-        gstt = lambda x: utils.localtime(x.start_time).time()
-        return dict([(i.id, gstt(i)) for i in instances])
+        local_starts = utils.localtime_many([i.start_time for i in instances])
+        return dict([(i.id, x.time())
+                     for i, x in zip(instances, local_starts)])
 
-    def get_component_type_name(self, name):
-        id_names = EncounterComponentType.get_selection_list()
-        title_index = self.id % len(id_names)
-        return id_names[title_index][2]
+    @classmethod
+    def get_union_type_info(cls, instances, names):
+        '''serves component_type and is_union_comp from the precomputed
+        union index of the component types'''
+        single = not isinstance(names, list)
+        if single:
+            names = [names]
+        union_index = EncounterComponentType.get_union_index()
+        index_count = len(union_index)
+        result = {}
+        for name in names:
+            if name == 'component_type':
+                result[name] = dict([
+                    (i.id, union_index[i.id % index_count].code)
+                    for i in instances])
+            elif name == 'is_union_comp':
+                result[name] = dict([(i.id, True) for i in instances])
+        if single:
+            return result[names[0]]
+        return result
 
-    def get_report_info(self, name):
-        real_component = self.union_unshard(self.id)
-        return real_component.get_report_info(name)
+    @classmethod
+    def get_cached_report_info(cls, instances, name):
+        '''returns the report_info of the real components from the
+        cache of each component model'''
+        pool = Pool()
+        by_model = cls.union_unshard_many(instances, grouped=True)
+        result = {}
+        for model_name, records in by_model.items():
+            Model = pool.get(model_name)
+            texts = Model.get_cached_report_info(records, name)
+            for real_id, text in texts.items():
+                result[cls.union_shard(real_id, model_name)] = text
+        return result
 
-    def get_is_union(self, name):
-        return True
+    @classmethod
+    @ModelView.button
+    def sign_components(cls, components):
+        '''signs the real components, with one write for each component
+        model'''
+        pool = Pool()
+        by_model = cls.union_unshard_many(components, grouped=True)
+        for model_name, records in by_model.items():
+            pool.get(model_name).sign_components(records)
 
     @classmethod
     @ModelView.button_action(
@@ -1,4 +1,5 @@
 from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
 from .base import BaseComponent, SIGNED_STATES as STATES
 
 DASHER = ('-' * 15, )  # minimal text based spacer line
@@ -52,23 +53,60 @@ class EncounterClinical(BaseComponent):
         super(EncounterClinical, cls).__setup__()
         cls.notes.help = 'Clinical history and examination findings'
 
-    def make_critical_info(self):
+    @classmethod
+    def make_critical_infos(cls, records):
+        pool = Pool()
+        SignsAndSymptoms = pool.get('gnuhealth.signs_and_symptoms')
+        DiagnosticHypothesis = pool.get('gnuhealth.diagnostic_hypothesis')
+        Pathology = pool.get('gnuhealth.pathology')
+        # one read per model for all the records instead of one per record
+        components = cls.read(map(int, records), [
+            'diagnosis', 'signs_symptoms', 'diagnostic_hypothesis'])
+        signs = dict((x['id'], x['clinical']) for x in SignsAndSymptoms.read(
+            [y for c in components for y in c['signs_symptoms']],
+            ['clinical']))
+        hypotheses = dict((x['id'], x['pathology'])
+                          for x in DiagnosticHypothesis.read(
+            [y for c in components for y in c['diagnostic_hypothesis']],
+            ['pathology']))
+        pathology_ids = set(signs.values() + hypotheses.values())
+        pathology_ids.update([c['diagnosis'] for c in components
+                              if c['diagnosis']])
+        pathologies = dict((x['id'], x) for x in Pathology.read(
+            list(pathology_ids), ['code', 'rec_name']))
+        result = {}
+        for c in components:
+            diagnosis = c['diagnosis'] and pathologies[c['diagnosis']]
+            result[c['id']] = cls.format_critical_info(
+                [pathologies[signs[x]]['code'] for x in c['signs_symptoms']],
+                diagnosis and diagnosis['rec_name'],
+                [pathologies[hypotheses[x]]['code']
+                 for x in c['diagnostic_hypothesis']])
+        return result
+
+    @staticmethod
+    def format_critical_info(sign_codes, diagnosis, hypothesis_codes):
         out = []
-        if self.signs_symptoms:
-            citxt = ', '.join([x.clinical.code for x in self.signs_symptoms])
+        if sign_codes:
+            citxt = ', '.join(sign_codes)
             if citxt:
                 out.append(u'Signs: %s' % citxt)
-        if self.diagnosis:
-            out.append(self.diagnosis.rec_name)
-        if self.diagnostic_hypothesis:
-            citxt = u', '.join([x.pathology.code
-                                for x in self.diagnostic_hypothesis])
-            if citxt and self.diagnosis:
+        if diagnosis:
+            out.append(diagnosis)
+        if hypothesis_codes:
+            citxt = u', '.join(hypothesis_codes)
+            if citxt and diagnosis:
                 out.append(u'or %s' % citxt)
             else:
                 out.append(u'DDx: %s' % citxt)
         return '; '.join(out)
 
+    def make_critical_info(self):
+        return self.format_critical_info(
+            [x.clinical.code for x in self.signs_symptoms],
+            self.diagnosis and self.diagnosis.rec_name,
+            [x.pathology.code for x in self.diagnostic_hypothesis])
+
     def get_report_info(self, name):
         lines = [(u'== Clinical ==',)]
         if self.signs_symptoms:
@@ -105,7 +143,7 @@ class EncounterClinical(BaseComponent):
 # Modification to GNU Health Default classes to point them here instead
 class RewireEvaluationPointer(ModelSQL):
     clinical_component = fields.Many2One('gnuhealth.encounter.clinical',
-                                         'Clinic', readonly=True)
+                                         'Clinic', readonly=True, select=True)
 
     # @classmethod
     # def __setup__(cls):
@@ -151,16 +189,35 @@ class EncounterProcedures(BaseComponent):
             lines.append((str(self.notes), ))
         return u'\n'.join([' '.join(x) for x in lines])
 
-    def make_critical_info(self):
-        if self.procedures:
-            if len(self.procedures) <= 2:
-                out = [x.procedure.rec_name for x in self.procedures]
-            else:
-                out = [x.procedure.name for x in self.procedures]
+    @classmethod
+    def make_critical_infos(cls, records):
+        pool = Pool()
+        Directions = pool.get('gnuhealth.directions')
+        Procedure = pool.get('gnuhealth.procedure')
+        # one read per model for all the records instead of one per record
+        components = cls.read(map(int, records), ['procedures'])
+        directions = dict((x['id'], x['procedure']) for x in Directions.read(
+            [y for c in components for y in c['procedures']], ['procedure']))
+        procedures = dict((x['id'], x) for x in Procedure.read(
+            list(set(directions.values())), ['name', 'rec_name']))
+        return dict((c['id'], cls.format_critical_info(
+            [procedures[directions[x]] for x in c['procedures']]))
+            for c in components)
+
+    @staticmethod
+    def format_critical_info(procedures):
+        '''procedures are dicts with the name and rec_name of each one'''
+        if len(procedures) <= 2:
+            out = [x['rec_name'] for x in procedures]
         else:
-            out = []
+            out = [x['name'] for x in procedures]
         return u', '.join(out)
 
+    def make_critical_info(self):
+        return self.format_critical_info(
+            [{'name': x.procedure.name, 'rec_name': x.procedure.rec_name}
+             for x in self.procedures])
+
 
 # PATIENT EVALUATION DIRECTIONS
 class Directions(ModelSQL, ModelView):
@@ -168,4 +225,5 @@ class Directions(ModelSQL, ModelView):
     __name__ = 'gnuhealth.directions'
 
     encounter_component = fields.Many2One('gnuhealth.encounter.procedures',
-                                          'Component', readonly=True)
+                                          'Component', readonly=True,
+                                          select=True)
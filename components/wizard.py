@@ -1,14 +1,21 @@
 
-import re
 from trytond.wizard import (Wizard, StateView, Button, StateTransition)
+from trytond.cache import LRUDict
 from trytond.pool import Pool
 from trytond.model import ModelView, fields
 from trytond.transaction import Transaction
 from trytond.pyson import Eval, Bool, Not
 from .base import EncounterComponent
+from .. import utils
 from ..encounter_component_type import (EncounterComponentType,
                                         UnknownEncounterComponentType)
 from datetime import datetime
+from threading import Lock
+
+# (database, registry version, user, state name) => list of the names of
+# the fields in the form of the component type
+_component_fields_cache = LRUDict(256)
+_component_fields_lock = Lock()
 
 
 def model2dict(record, fields=None, with_one2many=True):
@@ -39,6 +46,17 @@ def model2dict(record, fields=None, with_one2many=True):
 
 
 def get_component_modelview(component_type_id, model_name=None):
+        # active component types are found in the registry without a query
+        if component_type_id:
+            type_id = int(component_type_id)
+            type_info = [x for x in EncounterComponentType.get_union_index()
+                         if x.id == type_id]
+        else:
+            type_info = [EncounterComponentType.get_model_index().get(
+                model_name)]
+        if type_info and type_info[0]:
+            return (type_info[0].model, type_info[0].view_form)
+
         if component_type_id:
             # mvd = model view data
             mvd = EncounterComponentType.read(
@@ -55,9 +73,6 @@ def get_component_modelview(component_type_id, model_name=None):
         except IndexError:  # there is no component type for this model
             raise UnknownEncounterComponentType(model_name)
 
-txtonly = re.compile('([A-Za-z]+)')
-name_fix = lambda x: '_'.join([p.lower() for p in txtonly.findall(x)])
-
 
 class ChooseComponentTypeView(ModelView):
     'Choose Component'
@@ -68,14 +83,14 @@ class ChooseComponentTypeView(ModelView):
 
     @classmethod
     def component_type_selection(cls):
-        pool = Pool()
-        ModelAccess = pool.get('ir.model.access')
         pdefault = {'create': False}  # default if model not found in access
         triple = EncounterComponentType.get_selection_list()
-        model_access = ModelAccess.get_access([x[3] for x in triple])
+        state_names = dict([(x.id, x.state_name) for x in
+                            EncounterComponentType.get_union_index()])
+        model_access = utils.get_model_access([x[3] for x in triple])
         # model access is a dict of dict with models and access
         # trim the list to just the models you have access to
-        return [(name_fix(x[2]), x[1]) for x in triple
+        return [(state_names[x[0]], x[1]) for x in triple
                 if model_access.get(x[3], pdefault).get('create', False)]
 
 
@@ -153,15 +168,31 @@ class EditComponentWizard(Wizard):
     def __setup__(cls):
         super(EditComponentWizard, cls).__setup__()
         # fetch the component types and create a ComponentStateView for each
-        component_types = [(x[0], name_fix(x[2]), x[3]) for x in
-                           EncounterComponentType.get_selection_list()]
-
         cls._component_model_map = {}
-        for type_id, type_name, type_model in component_types:
-            setattr(cls, type_name, ComponentStateView(type_id))
-            cls._component_model_map[type_model] = type_name
+        cls._component_registry_version = None
+        for type_info in EncounterComponentType.get_union_index():
+            setattr(cls, type_info.state_name,
+                    ComponentStateView(type_info.id))
+            cls._component_model_map[type_info.model] = type_info.state_name
+
+    @classmethod
+    def add_component_states(cls):
+        '''creates the ComponentStateView of the component types that were
+        registered after the pool was set up'''
+        version = EncounterComponentType.get_registry_version()
+        if version == cls._component_registry_version:
+            return
+        for type_info in EncounterComponentType.get_union_index():
+            if type_info.state_name not in cls.states:
+                state = ComponentStateView(type_info.id)
+                setattr(cls, type_info.state_name, state)
+                cls.states[type_info.state_name] = state
+            cls._component_model_map[type_info.model] = type_info.state_name
+        cls._component_registry_version = version
 
     def __init__(self, sessionid):
+        # the states must exist before the session data is loaded into them
+        self.add_component_states()
         super(EditComponentWizard, self).__init__(sessionid)
         tact = Transaction()
         active_model = tact.context.get('active_model')
@@ -169,19 +200,18 @@ class EditComponentWizard(Wizard):
 
         self._component_data = {'model': active_model, 'active_id': active_id,
                                 'obj_data': None, 'selected_component': None}
-        ModelAccess = Pool().get('ir.model.access')
-        self._component_model_access = ModelAccess.get_access(
+        self._component_model_access = utils.get_model_access(
             self._component_model_map.keys())
         real_component = None
         if active_model != 'gnuhealth.encounter':  # open button was clicked
-            real_component = EncounterComponent.union_unshard(active_id)
+            real_component, = EncounterComponent.union_unshard_many(
+                [active_id])
             vis = self._component_model_access[real_component.__name__]['read']
             if vis:  # permission granted to view this model
                 try:
                     sc = self._component_model_map[real_component.__name__]
-                except IndexError:
+                except KeyError:
                     raise UnknownEncounterComponentType(real_component.__name__)
-                    sc = None
                 self._component_data['selected_component'] = sc
                 self._component_data['obj'] = real_component
             else:
@@ -205,10 +235,7 @@ class EditComponentWizard(Wizard):
         component_model = Pool().get(state.model_name)
         encounter_id = self._component_data['active_id']
         component_data = {'encounter': encounter_id}
-        view = state.get_view()
-        field_names = view['fields'].keys()
-        if 'id' in field_names:
-            del field_names[field_names.index['id']]
+        field_names = self.get_default_field_names(state_name)
         component_data.update(component_model.default_get(field_names))
         real_component = component_model(**component_data)
         setattr(self, 'component', real_component)
@@ -217,14 +244,32 @@ class EditComponentWizard(Wizard):
                                     selected_component=state_name)
         return state_name
 
+    def get_default_field_names(self, state_name):
+        '''returns the names of the fields in the form of the
+        :param state_name: component state. The view is only parsed the
+        first time for each user and version of the component type
+        registry'''
+        transaction = Transaction()
+        key = (transaction.cursor.database_name,
+               EncounterComponentType.get_registry_version(),
+               transaction.user, state_name)
+        with _component_fields_lock:
+            field_names = _component_fields_cache.get(key)
+        if field_names is None:
+            # default_get also gives False to the booleans that have no
+            # default_ method, so every field of the form is kept
+            view = self.states[state_name].get_view()
+            field_names = [x for x in view['fields'] if x != 'id']
+            with _component_fields_lock:
+                _component_fields_cache[key] = field_names
+        return field_names[:]
+
     def transition_sign_x(self):
         state_name = self._component_data['selected_component']
         state_model = getattr(self, state_name)
-        pool = Pool()
         if not getattr(state_model, '_values', False):
             state_model._values = {}
-        healthprof_model = pool.get('gnuhealth.healthprofessional')
-        healthprof = healthprof_model.get_health_professional()
+        healthprof = utils.get_health_professional()
         state_model.signed_by = healthprof
         state_model.sign_time = datetime.now()
         return self.transition_save_x()
@@ -235,7 +280,7 @@ class EditComponentWizard(Wizard):
         state_name = self._component_data['selected_component']
         if model != 'gnuhealth.encounter':
             compid = self._component_data['active_id']
-            component = EncounterComponent.union_unshard(compid)
+            component, = EncounterComponent.union_unshard_many([compid])
         state_model = getattr(self, state_name)
         state_model.pre_save()
         if component:
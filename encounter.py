@@ -1,12 +1,28 @@
 
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+from sql import Column
+from sql.aggregate import Max
+from sql.conditionals import Coalesce, Greatest
+from sql.functions import Function, Extract, CurrentTimestamp
+from trytond import backend
+from trytond.config import config
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.pyson import Eval, Not, Equal, Or, Greater, In, Len
-from trytond.modules.health import HealthInstitution, HealthProfessional
+from trytond.modules.health import HealthInstitution
 from . import utils
+from . import indexes
+
+
+ENCOUNTER_CODE = re.compile(r'^EV(\d+)$', re.IGNORECASE)
+
+
+class Age(Function):
+    __slots__ = ()
+    _function = 'AGE'
 
 
 class PatientEncounter(ModelSQL, ModelView):
@@ -23,21 +39,21 @@ class PatientEncounter(ModelSQL, ModelView):
          ('done', 'Done'),
          ('signed', 'Signed'),
          ('invalid', 'Invalid')],
-        'State', readonly=True, sort=False,
+        'State', readonly=True, sort=False, select=True,
         states={'invisible': Equal(Eval('state'), 'signed')})
     patient = fields.Many2One(
-        'gnuhealth.patient', 'Patient', required=True,
+        'gnuhealth.patient', 'Patient', required=True, select=True,
         states={'readonly': Eval('id', 0) > 0})
     primary_complaint = fields.Char('Primary complaint', states=STATES)
     start_time = fields.DateTime('Start', required=True, states=STATES)
     end_time = fields.DateTime('End', states=STATES)
     institution = fields.Many2One('gnuhealth.institution', 'Institution',
-                                  required=True, states=STATES)
+                                  required=True, select=True, states=STATES)
     appointment = fields.Many2One(
         'gnuhealth.appointment', 'Appointment',
         domain=[('patient', '=', Eval('patient'))], depends=['patient'],
         help='Enter or select the appointment related to this encounter',
-        states=STATES)
+        states=STATES, select=True)
     next_appointment = fields.Many2One(
         'gnuhealth.appointment', 'Next Appointment',
         # domain=['OR', ('state', '=', 'free'),
@@ -54,20 +70,24 @@ class PatientEncounter(ModelSQL, ModelView):
                                  'Components')
     summary = fields.Function(fields.Text('Summary'), 'get_encounter_summary')
     short_summary = fields.Function(fields.Text('Summary'),
-                                    'get_short_summary')
+                                    'get_list_fields')
+    # frozen at signing, these are what the signed encounter shows
+    signed_summary = fields.Text('Signed summary', readonly=True)
+    signed_short_summary = fields.Text('Signed short summary', readonly=True)
     # Patient identifier fields
-    upi = fields.Function(fields.Char('UPI'), 'get_upi_mrn')
+    upi = fields.Function(fields.Char('UPI'), 'get_list_fields')
     medical_record_num = fields.Function(
-        fields.Char('Medical Record Number'), 'get_upi_mrn')
-    sex_display = fields.Function(fields.Char('Sex'),
-                                  'get_person_patient_field')
+        fields.Char('Medical Record Number'), 'get_list_fields')
+    sex_display = fields.Function(fields.Char('Sex'), 'get_list_fields')
     age = fields.Function(fields.Char('Age', help="Age at start of encounter"),
-                          'get_patient_age')
+                          'get_list_fields')
+    patient_age = fields.Char('Age at encounter', readonly=True,
+                              help="Stored age at start of encounter")
     crypto_enabled = fields.Function(fields.Boolean('Crypto Enabled'),
                                      'get_crypto_enabled')
     clinicians = fields.Function(
         fields.One2Many('gnuhealth.healthprofessional', 'encounter',
-                        'Clinicians'), 'get_clinicians',
+                        'Clinicians'), 'get_list_fields',
         searcher='search_clinicians')
 
     @classmethod
@@ -79,7 +99,8 @@ class PatientEncounter(ModelSQL, ModelView):
             'end_date_before_start': 'End time cannot be before'
             ' Start time\n"%(start_time)s"',
             'end_date_required': 'End time is required for finishing',
-            'unsigned_components': 'There are unsigned components.'
+            'unsigned_components': 'There are unsigned components in '
+                                   'these encounters:\n%(encounters)s'
                                    # 'This encounter cannot be signed'
         })
 
@@ -97,6 +118,11 @@ class PatientEncounter(ModelSQL, ModelView):
                                 ['signed', 'in_progress', 'invalid'])}
         })
 
+    @classmethod
+    def __register__(cls, module_name):
+        super(PatientEncounter, cls).__register__(module_name)
+        indexes.create_indexes(cls._table, indexes.ENCOUNTER_INDEXES)
+
     @classmethod
     def create(cls, vlist):
         '''
@@ -111,8 +137,20 @@ class PatientEncounter(ModelSQL, ModelView):
                 appointments.append(encounter['appointment'])
         appts = Appointment.browse(appointments)
         Appointment.write(appts, {'state': 'processing'})
+        cls.update_patient_age(retval)
         return retval
 
+    @classmethod
+    def write(cls, *args):
+        super(PatientEncounter, cls).write(*args)
+        actions = iter(args)
+        age_changed = []
+        for encounters, values in zip(actions, actions):
+            if 'start_time' in values or 'patient' in values:
+                age_changed.extend(encounters)
+        if age_changed:
+            cls.update_patient_age(age_changed)
+
     @classmethod
     def validate(cls, records):
         for e in records:
@@ -128,22 +166,43 @@ class PatientEncounter(ModelSQL, ModelView):
     @classmethod
     @ModelView.button
     def sign_finish(cls, encounters):
-        signing_hp = HealthProfessional().get_health_professional()
+        signing_hp = utils.get_health_professional()
         if not signing_hp:
             cls.raise_user_error('health_professional_warning')
         #ToDO: set all the not-done components to DONE as well and sign
         # the unsigned ones
         # No! Components should be individually signed.
-        for encounter in encounters:
-            for comp in encounter.components:
-                if not comp.signed_by:
-                    cls.raise_user_error('unsigned_components')
+        unsigned = cls.get_unsigned_encounters(encounters)
+        if unsigned:
+            cls.raise_user_error('unsigned_components', {
+                'encounters': '\n'.join([x.rec_name
+                                         for x in cls.browse(unsigned)])})
 
         cls.write(encounters, {
             'state': 'signed',
             'signed_by': signing_hp,
             'sign_time': datetime.now()
         })
+        cls.update_signed_summary(encounters)
+
+    @classmethod
+    def get_unsigned_encounters(cls, encounters):
+        '''returns the ids of the :param encounters: that have active
+        components that are not signed, using one query across all the
+        component tables'''
+        EncounterComponent = Pool().get('gnuhealth.encounter.component')
+        cursor = Transaction().cursor
+        ids = map(int, encounters)
+        unsigned = set()
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*EncounterComponent.union_select(
+                ['encounter'],
+                where=lambda t: (t.encounter.in_(sub_ids)
+                                 & (t.active == True)
+                                 & (t.signed_by == None))))
+            unsigned.update([x for x, in cursor.fetchall()])
+        return sorted(unsigned)
 
     @classmethod
     @ModelView.button
@@ -166,11 +225,79 @@ class PatientEncounter(ModelSQL, ModelView):
         Appointment = Pool().get('gnuhealth.appointment')
         Appointment.write(appointments, {'state': 'done'})
 
+    @classmethod
+    def finish_stale(cls, hours=None, chunk_size=None):
+        '''cron job that sets the encounters still in progress more than
+        :param hours: after they started to done. Encounters without an
+        end time end when their last component did, at least a minute after
+        they started. Encounters without components, such as those made
+        in advance for patients who never came, end a minute after they
+        started. The encounters and their appointments are updated in
+        chunks of :param chunk_size: and each chunk is committed on its
+        own'''
+        if hours is None:
+            hours = config.getint('health_encounter', 'stale_encounter_hours',
+                                  default=24)
+        if chunk_size is None:
+            chunk_size = config.getint('health_encounter',
+                                       'stale_encounter_chunk_size',
+                                       default=500)
+        pool = Pool()
+        Appointment = pool.get('gnuhealth.appointment')
+        EncounterComponent = pool.get('gnuhealth.encounter.component')
+        transaction = Transaction()
+        table = cls.__table__()
+        appointment = Appointment.__table__()
+        components = EncounterComponent.union_select(
+            ['encounter', 'start_time', 'end_time'],
+            where=lambda t: t.active == True)
+        cutoff = datetime.now() - timedelta(hours=hours)
+
+        total = 0
+        last_id = 0
+        while True:
+            cursor = transaction.cursor
+            cursor.execute(*table.select(
+                table.id,
+                where=((table.state == 'in_progress')
+                       & (table.start_time < cutoff)
+                       & (table.id > last_id)),
+                order_by=table.id.asc, limit=chunk_size))
+            ids = [x for x, in cursor.fetchall()]
+            if not ids:
+                break
+            last_id = ids[-1]
+
+            last_component_time = components.select(
+                Max(Coalesce(Column(components, 'end_time'),
+                             Column(components, 'start_time'))),
+                where=Column(components, 'encounter') == table.id)
+            cursor.execute(*table.update(
+                [table.state, table.end_time, table.write_date,
+                 table.write_uid],
+                # validate wants the end strictly after the start,
+                # GREATEST ignores the NULL of encounters without components
+                ['done', Coalesce(table.end_time, Greatest(
+                    last_component_time,
+                    table.start_time + timedelta(minutes=1))),
+                 CurrentTimestamp(), transaction.user],
+                where=table.id.in_(ids)))
+            cursor.execute(*appointment.update(
+                [appointment.state, appointment.write_date,
+                 appointment.write_uid],
+                ['done', CurrentTimestamp(), transaction.user],
+                where=appointment.id.in_(table.select(
+                    table.appointment,
+                    where=table.id.in_(ids) & (table.appointment != None)))))
+            cursor.commit()
+            total += len(ids)
+        return total
+
     @classmethod
     @ModelView.button_action(
         'health_encounter.health_wizard_encounter_edit_component')
     def add_component(cls, components, *a, **k):
-        hp = HealthProfessional.get_health_professional()
+        hp = utils.get_health_professional()
         if not hp:
             cls.raise_user_error('health_professional_warning')
 
@@ -178,7 +305,7 @@ class PatientEncounter(ModelSQL, ModelView):
     @ModelView.button_action(
         'health_encounter.health_wizard_encounter_edit_component')
     def add_extra_component(cls, components, *a, **k):
-        hp = HealthProfessional.get_health_professional()
+        hp = utils.get_health_professional()
         if not hp:
             cls.raise_user_error('health_professional_warning')
 
@@ -201,45 +328,177 @@ class PatientEncounter(ModelSQL, ModelView):
     def get_crypto_enabled(self, name):
         return False
 
-    def get_rec_name(self, name):
-        localstart = utils.localtime(self.start_time)
-        line = ['EV%05d' % self.id, self.patient.name.name,
-                '(%s /MRN:%s)' % (self.upi, self.medical_record_num),
-                self.sex_display, self.age, 'on %s' % localstart.ctime()]
-        return ' '.join(line)
-
-    def get_person_patient_field(self, name):
-        if name in ['sex_display']:
-            sex = getattr(self.patient.name, name,
-                          getattr(self.patient.name, 'sex', '?'))
-            return len(sex) == 1 and sex.upper() or sex
-        if name in ['age']:
-            return getattr(self.patient, name)
-        return ''
-
-    def get_upi_mrn(self, name):
-        if name == 'upi':
-            return self.patient.puid
-        elif name == 'medical_record_num':
-            return getattr(self.patient, 'medical_record_num', '')
-        return ''
-
-    def get_encounter_summary(self, name):
-        summary_texts = []
-        for component in self.components:
-            real_component = component.union_unshard(component.id)
-            report_info = real_component.report_info.split(u'\n')
-            report_info.insert(1, real_component.byline)
-            summary_texts.append(u'\n'.join(report_info))
+    @classmethod
+    def get_patient_fields(cls, encounters):
+        '''returns a dict of encounter id => dict of the patient details
+        shown on the encounter (patient_name, upi, medical_record_num and
+        sex_display). The patients and their parties are browsed once for
+        the whole batch'''
+        Patient = Pool().get('gnuhealth.patient')
+        patient_ids = list(set([e.patient.id for e in encounters]))
+        details = {}
+        for patient in Patient.browse(patient_ids):
+            party = patient.name
+            sex = getattr(party, 'sex_display', getattr(party, 'sex', '?'))
+            sex = sex or '?'
+            details[patient.id] = {
+                'patient_name': party.name,
+                'upi': patient.puid,
+                'medical_record_num': getattr(patient, 'medical_record_num',
+                                              ''),
+                'sex_display': len(sex) == 1 and sex.upper() or sex}
+        return dict([(e.id, details[e.patient.id]) for e in encounters])
+
+    @classmethod
+    def get_rec_name(cls, encounters, name):
+        patient_fields = cls.get_patient_fields(encounters)
+        ages = cls.get_patient_age(encounters, 'age')
+        local_starts = utils.localtime_many(
+            [e.start_time for e in encounters])
+        names = {}
+        for encounter, localstart in zip(encounters, local_starts):
+            details = patient_fields[encounter.id]
+            line = ['EV%05d' % encounter.id, details['patient_name'],
+                    '(%s /MRN:%s)' % (details['upi'],
+                                      details['medical_record_num']),
+                    details['sex_display'], ages[encounter.id],
+                    'on %s' % localstart.ctime()]
+            names[encounter.id] = ' '.join(line)
+        return names
+
+    @classmethod
+    def search_rec_name(cls, name, clause):
+        '''EVnnnnn is looked up by id. Anything else is matched against
+        the UPI, medical record number and name of the patient'''
+        field, operator, value = clause
+        Patient = Pool().get('gnuhealth.patient')
+        if operator.startswith('!') or operator.startswith('not '):
+            bool_op = 'AND'
+        else:
+            bool_op = 'OR'
+        if isinstance(value, basestring):
+            match = ENCOUNTER_CODE.match(value.strip('%'))
+            if match:
+                id_operator = '!=' if bool_op == 'AND' else '='
+                return [('id', id_operator, int(match.group(1)))]
+        domain = [bool_op, ('patient.puid', operator, value)]
+        if 'medical_record_num' in Patient._fields:
+            domain.append(('patient.medical_record_num', operator, value))
+        domain.append(('patient', operator, value))
+        return domain
+
+    @classmethod
+    def get_list_fields(cls, encounters, names):
+        '''computes the Function fields shown in the encounter list for
+        a page of encounters. The patients, parties and components are
+        loaded once and shared by all the fields asked for'''
+        single = not isinstance(names, list)
+        if single:
+            names = [names]
+        result = {}
+        patient_names = [x for x in names
+                         if x in ('upi', 'medical_record_num', 'sex_display')]
+        if patient_names:
+            details = cls.get_patient_fields(encounters)
+            for fname in patient_names:
+                result[fname] = dict([(k, v[fname])
+                                      for k, v in details.items()])
+        if 'age' in names:
+            result['age'] = cls.get_patient_age(encounters, 'age')
+        if 'short_summary' in names:
+            result['short_summary'] = cls.get_short_summary(
+                encounters, 'short_summary')
+        if 'clinicians' in names:
+            result['clinicians'] = cls.get_clinicians(encounters,
+                                                      'clinicians')
+        if single:
+            return result[names[0]]
+        return result
+
+    @classmethod
+    def get_encounter_summary(cls, encounters, name):
+        '''returns the summary text for each encounter. Signed encounters
+        return the text stored when they were signed'''
+        summaries = dict([(e.id, e.signed_summary) for e in encounters
+                          if e.state == 'signed' and e.signed_summary])
+        summaries.update(cls.compute_encounter_summary(
+            [e for e in encounters if e.id not in summaries]))
+        return summaries
+
+    @classmethod
+    def compute_encounter_summary(cls, encounters):
+        '''returns the summary text built from the components of each
+        encounter. The real components of all the encounters are grouped
+        by model so that each component model is read once for the whole
+        batch'''
+        pool = Pool()
+        EncounterComponent = pool.get('gnuhealth.encounter.component')
+        union_ids = [c.id for e in encounters for c in e.components]
+        by_model = EncounterComponent.union_unshard_many(union_ids,
+                                                         grouped=True)
+
+        # read report_info and byline once per model and key the
+        # results by the union id
+        component_texts = {}
+        for model_name, records in by_model.items():
+            Model = pool.get(model_name)
+            for row in Model.read(map(int, records),
+                                  ['report_info', 'byline']):
+                report_info = (row['report_info'] or u'').split(u'\n')
+                report_info.insert(1, row['byline'])
+                union_id = EncounterComponent.union_shard(row['id'],
+                                                          model_name)
+                component_texts[union_id] = u'\n'.join(report_info)
+
+        summaries = {}
+        for encounter in encounters:
             # TODO: Show extra components differently from regular ones
-        return u'\n\n'.join(summary_texts)
+            summaries[encounter.id] = u'\n\n'.join(
+                [component_texts[c.id] for c in encounter.components])
+        return summaries
 
-    def get_short_summary(self, name):
-        summary_texts = []
-        for component in self.components:
-            summary_texts.append((component.component_type,
-                                  component.critical_info))
-        return u'\n'.join([': '.join(x) for x in summary_texts])
+    @classmethod
+    def get_short_summary(cls, encounters, name):
+        summaries = dict([(e.id, e.signed_short_summary) for e in encounters
+                          if e.state == 'signed' and e.signed_short_summary])
+        summaries.update(cls.compute_short_summary(
+            [e for e in encounters if e.id not in summaries]))
+        return summaries
+
+    @classmethod
+    def compute_short_summary(cls, encounters):
+        EncounterComponent = Pool().get('gnuhealth.encounter.component')
+        component_ids = [c.id for e in encounters for c in e.components]
+        summary_texts = dict([
+            (x['id'], u': '.join([x['component_type'] or u'',
+                                  x['critical_info'] or u'']))
+            for x in EncounterComponent.read(
+                component_ids, ['component_type', 'critical_info'])])
+        return dict([(e.id, u'\n'.join([summary_texts[c.id]
+                                         for c in e.components]))
+                     for e in encounters])
+
+    @classmethod
+    def update_signed_summary(cls, encounters):
+        '''stores the summary and short summary of the encounters as they
+        are now. It is the frozen record of what was signed. Uses one
+        UPDATE for each distinct pair of summaries'''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        summaries = cls.compute_encounter_summary(encounters)
+        short_summaries = cls.compute_short_summary(encounters)
+        ids_by_value = {}
+        for encounter_id in map(int, encounters):
+            ids_by_value.setdefault(
+                (summaries[encounter_id], short_summaries[encounter_id]),
+                []).append(encounter_id)
+        for (summary, short_summary), ids in ids_by_value.items():
+            for i in range(0, len(ids), cursor.IN_MAX):
+                sub_ids = ids[i:i + cursor.IN_MAX]
+                cursor.execute(*table.update(
+                    [table.signed_summary, table.signed_short_summary],
+                    [summary, short_summary],
+                    where=table.id.in_(sub_ids)))
 
     def real_component(self, name=None):
         '''retuns the real component objects.
@@ -248,8 +507,9 @@ class PatientEncounter(ModelSQL, ModelView):
         name can be the name of the model or the shortname displayed
         on screen, case insensitive.
         '''
-        comps = [(x.component_type, x.union_unshard(x.id))
-                 for x in self.components]
+        EncounterComponent = Pool().get('gnuhealth.encounter.component')
+        comps = zip([x.component_type for x in self.components],
+                    EncounterComponent.union_unshard_many(self.components))
         typedict = {}
         real_comps = []
         # modeldict = {}
@@ -263,42 +523,129 @@ class PatientEncounter(ModelSQL, ModelView):
         else:
             return real_comps
 
-    def get_clinicians(self, name):
+    @classmethod
+    def get_clinicians(cls, encounters, name):
         '''returns a list of IDs for the clinicians that performed
         components linked here'''
-        health_profs = [x.performed_by for x in self.components]
-        health_profs.extend([x.signed_by for x in self.components
-                             if x.sign_time])
-        return map(int, set(filter(None, health_profs)))
+        EncounterComponent = Pool().get('gnuhealth.encounter.component')
+        cursor = Transaction().cursor
+        ids = map(int, encounters)
+        health_profs = dict([(x, set()) for x in ids])
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            query = EncounterComponent.union_select(
+                ['encounter', 'performed_by', 'signed_by', 'sign_time'],
+                where=lambda t: t.encounter.in_(sub_ids) & (t.active == True))
+            cursor.execute(*query)
+            for encounter, performed_by, signed_by, sign_time in \
+                    cursor.fetchall():
+                if performed_by:
+                    health_profs[encounter].add(performed_by)
+                if signed_by and sign_time:
+                    health_profs[encounter].add(signed_by)
+        return dict([(k, list(v)) for k, v in health_profs.items()])
 
     @classmethod
-    def search_clinicians(self, name, clause):
+    def search_clinicians(cls, name, clause):
+        '''returns a domain with a subquery over the component tables
+        for the encounters performed or signed by the clinicians'''
         fld, operator, operand = clause
-        component_model = Pool().get('gnuhealth.encounter.component')
-        components = component_model.search([
-            'OR', ('performed_by', operator, operand),
-            ('signed_by', operator, operand)])
-        encounter_list = [x.encounter.id
-                          for x in component_model.browse(components)]
-        return [('id', 'in', encounter_list)]
+        pool = Pool()
+        EncounterComponent = pool.get('gnuhealth.encounter.component')
+        HealthProfessional = pool.get('gnuhealth.healthprofessional')
+
+        if operand is None and operator in ('=', '!='):
+            def where(table):
+                if operator == '=':
+                    return (((table.performed_by == None)
+                             | (table.signed_by == None))
+                            & (table.active == True))
+                return (((table.performed_by != None)
+                         | (table.signed_by != None))
+                        & (table.active == True))
+        else:
+            if isinstance(operand, basestring):
+                hp_domain = [('rec_name', operator, operand)]
+            else:
+                hp_domain = [('id', operator, operand)]
+            health_profs = HealthProfessional.search(hp_domain, query=True)
+
+            def where(table):
+                return ((table.performed_by.in_(health_profs)
+                         | table.signed_by.in_(health_profs))
+                        & (table.active == True))
+
+        query = EncounterComponent.union_select(['encounter'], where=where)
+        return [('id', 'in', query)]
 
     @classmethod
     def get_patient_age(cls, instances, name):
         '''
-        Uses the AGE function in the database to calculate the age at
-        the date at which the encounter started
+        returns the stored age at the start of the encounter. Encounters
+        that have not been backfilled yet are computed on the fly. The
+        stored age is recomputed when the date of birth changes
+        '''
+        ages = dict([(x.id, x.patient_age) for x in instances])
+        missing = [k for k, v in ages.items() if v is None]
+        if missing:
+            ages.update(cls.compute_patient_age(missing))
+        return ages
+
+    @classmethod
+    def compute_patient_age(cls, ids):
+        '''
+        returns a dict of encounter id => age at the date at which the
+        encounter started. Uses the AGE function on PostgreSQL and
+        computes the difference in python on other backends
         '''
-        c = Transaction().cursor
-        tbl = cls.__table__()
-        qry = "\n".join(
-            ["SET intervalstyle TO 'iso_8601';",
-             "SELECT a.id as id, COALESCE(btrim(lower("
-             "regexp_replace(AGE(a.start_time::date, c.dob)::varchar, "
-             "'([YMD])', '\\1 ', 'g')), 'p '), '--')  as showage ",
-             "from " + str(tbl) + " as a ",
-             " inner join gnuhealth_patient as b on a.patient=b.id",
-             " inner join party_party c on b.name=c.id"
-             " where a.id in %s ;"])
-        qry_parm = tuple(map(int, instances))
-        c.execute(qry, (qry_parm, ))
-        return dict([x for x in c.fetchall()])
+        pool = Pool()
+        Patient = pool.get('gnuhealth.patient')
+        Party = pool.get('party.party')
+        cursor = Transaction().cursor
+        encounter = cls.__table__()
+        patient = Patient.__table__()
+        party = Party.__table__()
+        join = encounter.join(
+            patient, condition=encounter.patient == patient.id).join(
+            party, condition=patient.name == party.id)
+        use_sql_age = backend.name() == 'postgresql'
+        if use_sql_age:
+            age = Age(encounter.start_time, party.dob)
+            columns = [encounter.id, party.dob, Extract('YEAR', age),
+                       Extract('MONTH', age), Extract('DAY', age)]
+        else:
+            columns = [encounter.id, party.dob, encounter.start_time]
+
+        ages = {}
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*join.select(*columns,
+                                        where=encounter.id.in_(sub_ids)))
+            for row in cursor.fetchall():
+                encounter_id, dob = row[:2]
+                if not dob:
+                    ages[encounter_id] = utils.format_age(None)
+                elif use_sql_age:
+                    ages[encounter_id] = utils.format_age(*row[2:])
+                else:
+                    delta = relativedelta(row[2].date(), dob)
+                    ages[encounter_id] = utils.format_age(
+                        delta.years, delta.months, delta.days)
+        return ages
+
+    @classmethod
+    def update_patient_age(cls, encounters):
+        '''computes and stores the age at encounter for the encounters
+        using one UPDATE for each distinct age'''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        ages = cls.compute_patient_age(map(int, encounters))
+        ids_by_age = {}
+        for encounter_id, age in ages.items():
+            ids_by_age.setdefault(age, []).append(encounter_id)
+        for age, ids in ids_by_age.items():
+            for i in range(0, len(ids), cursor.IN_MAX):
+                sub_ids = ids[i:i + cursor.IN_MAX]
+                cursor.execute(*table.update(
+                    [table.patient_age], [age],
+                    where=table.id.in_(sub_ids)))
@@ -1,9 +1,11 @@
 
 from trytond.model import ModelView, ModelSQL, fields
 from trytond import backend
+from trytond.cache import Cache
 from trytond.transaction import Transaction
 from collections import namedtuple
 import psycopg2
+import re
 
 __all__ = ['EncounterComponentType', 'UnknownEncounterComponentType']
 
@@ -13,7 +15,14 @@ class UnknownEncounterComponentType(Exception):
 
 
 ComponentTypeInfo = namedtuple('ComponentTypeInfo',
-                               ['id', 'name', 'code', 'model'])
+                               ['id', 'name', 'code', 'model', 'view_form'])
+# one entry per union model index of gnuhealth.encounter.component
+UnionTypeInfo = namedtuple('UnionTypeInfo',
+                           ['index', 'id', 'code', 'model', 'view_form',
+                            'state_name'])
+
+txtonly = re.compile('([A-Za-z]+)')
+name_fix = lambda x: '_'.join([p.lower() for p in txtonly.findall(x)])
 
 
 class EncounterComponentType(ModelSQL, ModelView):
@@ -32,6 +41,11 @@ class EncounterComponentType(ModelSQL, ModelView):
                             help='full xml id of view, e.g. module.xml_id')
     ordering = fields.Integer('Display order')
     active = fields.Boolean('Active')
+    # (version, [ComponentTypeInfo, ...], [UnionTypeInfo, ...],
+    # {model: UnionTypeInfo}) shared by all the workers. It is cleared on create, write and delete so each
+    # process reloads it on the next request after a change.
+    _selection_cache = Cache('gnuhealth.encounter.component_type.selection',
+                             context=False)
 
     @classmethod
     def __setup__(cls):
@@ -59,26 +73,73 @@ class EncounterComponentType(ModelSQL, ModelView):
         return True
 
     @classmethod
-    def get_selection_list(cls):
-        '''returns a list of active Encounter component types in a tuple
-        of (id, Name, Code, model)'''
-        try:
-            return cls._component_type_list
-        except AttributeError:
-            pass
+    def create(cls, vlist):
+        records = super(EncounterComponentType, cls).create(vlist)
+        cls._selection_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(EncounterComponentType, cls).write(*args)
+        cls._selection_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        super(EncounterComponentType, cls).delete(records)
+        cls._selection_cache.clear()
+
+    @classmethod
+    def _get_registry(cls):
+        '''returns the cached (version, selection list, union index, model
+        index) tuple, loading it from the database if it has been cleared'''
+        registry = cls._selection_cache.get('registry')
+        if registry is not None:
+            return registry
         cursor = Transaction().cursor
         TableHandler = backend.get('TableHandler')
         if not TableHandler.table_exist(cursor,
                                         'gnuhealth_encounter_component_type'):
-            return []
+            return (None, [], [], {})
         ectypes = cls.search_read(
             [('active', '=', True)],
-            fields_names=['id', 'name', 'code', 'model'],
+            fields_names=['id', 'name', 'code', 'model', 'view_form'],
             order=[('ordering', 'ASC'), ('name', 'ASC')])
-        cls._component_type_list = [ComponentTypeInfo(x['id'], x['name'],
-                                                      x['code'], x['model'])
-                                    for x in ectypes]
-        return cls._component_type_list
+        type_list = tuple([ComponentTypeInfo(x['id'], x['name'], x['code'],
+                                             x['model'], x['view_form'])
+                           for x in ectypes])
+        union_index = [UnionTypeInfo(i, x.id, x.code, x.model, x.view_form,
+                                     name_fix(x.code))
+                       for i, x in enumerate(type_list)]
+        model_index = dict([(x.model, x) for x in union_index])
+        registry = (hash(type_list), list(type_list), union_index,
+                    model_index)
+        cls._selection_cache.set('registry', registry)
+        return registry
+
+    @classmethod
+    def get_registry_version(cls):
+        '''returns a value that changes whenever the list of active
+        component types changes. Use it to key data derived from the
+        selection list'''
+        return cls._get_registry()[0]
+
+    @classmethod
+    def get_selection_list(cls):
+        '''returns a list of active Encounter component types as
+        ComponentTypeInfo tuples of (id, name, code, model, view_form)'''
+        return cls._get_registry()[1][:]
+
+    @classmethod
+    def get_union_index(cls):
+        '''returns the list of UnionTypeInfo for the active component
+        types. The position in the list is the remainder of a union
+        component id divided by the number of component types'''
+        return cls._get_registry()[2]
+
+    @classmethod
+    def get_model_index(cls):
+        '''returns a dict of model name => UnionTypeInfo'''
+        return cls._get_registry()[3]
 
     @classmethod
     def get_view_name(cls, ids):
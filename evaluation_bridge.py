@@ -1,12 +1,41 @@
 # Stuff that translates evaluations to encounters
-import sys
+import os
+import json
+import time
 from datetime import timedelta
+from multiprocessing import Pool as ProcessPool
+from optparse import OptionParser
 from trytond.modules.health.health import HealthInstitution
 from proteus import Model, config as pconfig
 from getpass import getpass
+from maintenance import start_pool
 
 DELAY = timedelta(0, 120)  # artificial 2 minute delay
 HERE = None
+CHUNK_SIZE = 200  # evaluations converted per transaction in batch mode
+WINDOW_SIZE = 5000  # evaluations fetched per page in batch mode
+SAMPLE_SIZE = 10  # ids listed for each discrepancy found by verify
+_worker = {}  # trytond pool of the current batch worker process
+
+# evaluation fields that cause a component to be created when any is set
+ANTHRO_FIELDS = ['weight', 'height', 'abdominal_circ', 'hip']
+AMBU_FIELDS = ['dehydration', 'temperature', 'osat', 'bpm',
+               'respiratory_rate', 'cholesterol_total', 'glycemia',
+               'ldl', 'hdl', 'tag', 'hba1c', 'systolic', 'diastolic',
+               'notes_complaint']
+MENTAL_FIELDS = ['judgment', 'tremor', 'violent', 'mood', 'orientation',
+                 'knowledge_current_events', 'abstraction', 'memory',
+                 'vocabulary', 'calculation_ability', 'object_recognition',
+                 'praxis']
+CLINICAL_FIELDS = ['diagnosis', 'info_diagnosis', 'directions',
+                   'diagnostic_hypothesis', 'secondary_conditions',
+                   'signs_and_symptoms']
+EXPECTED_COMPONENTS = [
+    ('gnuhealth.encounter.anthropometry', ANTHRO_FIELDS),
+    ('gnuhealth.encounter.ambulatory', AMBU_FIELDS),
+    ('gnuhealth.encounter.mental_status', MENTAL_FIELDS),
+    ('gnuhealth.encounter.clinical', CLINICAL_FIELDS),
+    ('gnuhealth.encounter.procedures', ['actions'])]
 
 def reductor(ev):
     def real_reductor(a, b):
@@ -60,7 +89,7 @@ def make_encounter(ev):
         'primary_complaint': ev.chief_complaint,
         'fvty': ev.first_visit_this_year}
     components = []
-    if ev.weight or ev.height or ev.abdominal_circ or ev.hip:
+    if any([getattr(ev, fld) for fld in ANTHRO_FIELDS]):
         comp = {
             'model': 'gnuhealth.encounter.anthropometry',
             'weight': ev.weight,
@@ -72,10 +101,7 @@ def make_encounter(ev):
             'whr': ev.whr}
         components.append(comp)
     reducer = reductor(ev)
-    ambu_fields = ['dehydration', 'temperature', 'osat', 'bpm',
-                   'respiratory_rate', 'cholesterol_total', 'glycemia',
-                   'ldl', 'hdl', 'tag', 'hba1c', 'systolic', 'diastolic',
-                   'notes_complaint']
+    ambu_fields = AMBU_FIELDS[:]
 
     if reduce(reducer, ambu_fields):
         ambu_fields = ambu_fields[1:-1]
@@ -86,10 +112,7 @@ def make_encounter(ev):
             comp.update(dehydration='moderate')
         components.append(comp)
 
-    mental_fields = ['judgment', 'tremor', 'violent', 'mood', 'orientation',
-                     'knowledge_current_events', 'abstraction', 'memory',
-                     'vocabulary', 'calculation_ability', 'object_recognition',
-                     'praxis']
+    mental_fields = MENTAL_FIELDS[:]
 
     if reduce(reducer, mental_fields):
         mental_fields.extend(['loc', 'loc_eyes', 'loc_verbal', 'loc_motor'])
@@ -99,9 +122,7 @@ def make_encounter(ev):
         comp.update([(fld, getattr(ev, fld)) for fld in mental_fields])
         components.append(comp)
 
-    clinical_fields = ['diagnosis', 'info_diagnosis', 'directions',
-                       'diagnostic_hypothesis', 'secondary_conditions',
-                       'signs_and_symptoms']
+    clinical_fields = CLINICAL_FIELDS[:]
     if reduce(reducer, clinical_fields):
         comp = {'model': 'gnuhealth.encounter.clinical'}
                 # 'diagnosis': Id(ev.diagnosis)}
@@ -190,23 +211,303 @@ def convert_remaining_evaluations(db, passwd, conffile):
 
     return encounters, bad_evals
 
-usage = """
-%s <config_file> <database_name>
+def create_encounters(evaluations, pool):
+    '''bulk version of create_encounter for use inside a trytond
+    transaction. :param evaluations: should be one browse list so that
+    their fields are read together. Encounters are created with one
+    create call and the components with one create per model'''
+    Encounter = pool.get('gnuhealth.encounter')
+    Evaluation = pool.get('gnuhealth.patient.evaluation')
+    converted = [make_encounter(ev) for ev in evaluations]
+    encounters = Encounter.create([encd for encd, _ in converted])
+
+    components = {}
+    for enc, (_, comps) in zip(encounters, converted):
+        for comp in comps:
+            model_name = comp.pop('model')
+            comp.update(encounter=enc.id)
+            components.setdefault(model_name, []).append(comp)
+    for model_name, vlist in components.items():
+        pool.get(model_name).create(vlist)
+
+    links = []
+    for ev, enc in zip(evaluations, encounters):
+        links.extend([[ev], {'encounter': enc.id}])
+    Evaluation.write(*links)
+    return encounters
+
+
+def _init_worker(dbname, conffile):
+    global HERE
+    from trytond.transaction import Transaction
+    pool = start_pool(dbname, conffile)
+    with Transaction().start(dbname, 0, context={}):
+        company = pool.get('company.company')(1)
+        Institution = pool.get('gnuhealth.institution')
+        institution, = Institution.search([('name', '=', company.party.id)])
+        HERE = institution.id
+    _worker.update(dbname=dbname, pool=pool)
+
+
+def _convert_in_transaction(eval_ids):
+    '''converts the evaluations in :param eval_ids: in a single
+    transaction. Returns a tuple of (number of encounters created,
+    error message or None)'''
+    from trytond.transaction import Transaction
+    pool = _worker['pool']
+    with Transaction().start(_worker['dbname'], 0, context={}):
+        cursor = Transaction().cursor
+        Evaluation = pool.get('gnuhealth.patient.evaluation')
+        try:
+            encounters = create_encounters(Evaluation.browse(eval_ids), pool)
+            cursor.commit()
+        except Exception, e:
+            cursor.rollback()
+            return (0, '%s: %s' % (e.__class__.__name__, e))
+    return (len(encounters), None)
+
+
+def convert_chunk(eval_ids):
+    '''converts a chunk of evaluations in one transaction. If the chunk
+    fails, its evaluations are retried one at a time so that only the
+    bad ones are left out. Returns a tuple of (eval_ids, number of
+    encounters created, dict of failed evaluation id => error)'''
+    created, error = _convert_in_transaction(eval_ids)
+    failed = {}
+    if error and len(eval_ids) > 1:
+        for eval_id in eval_ids:
+            one_created, one_error = _convert_in_transaction([eval_id])
+            created += one_created
+            if one_error:
+                failed[eval_id] = one_error
+    elif error:
+        failed[eval_ids[0]] = error
+    return (eval_ids, created, failed)
+
+
+def load_checkpoint(path):
+    '''returns the checkpoint stored in :param path: or a fresh one.
+    A checkpoint holds the last evaluation id of the last committed
+    window and the failed evaluation ids with their errors'''
+    if path and os.path.exists(path):
+        with open(path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        checkpoint['failed'] = dict([(int(k), v) for k, v in
+                                     checkpoint['failed'].items()])
+        return checkpoint
+    return {'last_id': 0, 'failed': {}}
+
+
+def save_checkpoint(path, checkpoint):
+    '''writes :param checkpoint: to :param path: atomically'''
+    if not path:
+        return
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file, indent=1)
+    os.rename(tmp_path, path)
+
+
+def convert_evaluations_batch(db, conffile, processes=None,
+                              chunk_size=CHUNK_SIZE, window=WINDOW_SIZE,
+                              checkpoint_path=None):
+    '''converts the unconverted evaluations in chunks of
+    :param chunk_size:, spread over a pool of :param processes: worker
+    processes (defaults to the number of cpus). Each chunk is created
+    and committed in its own transaction.
+
+    Evaluations are paged by id, :param window: at a time, so memory use
+    does not grow with the size of the table. After each window the last
+    id and the failed evaluations are saved to :param checkpoint_path:
+    and a later run with the same checkpoint resumes from there'''
+    from trytond.transaction import Transaction
+    # the workers are forked before trytond opens any connection here
+    workers = ProcessPool(processes, _init_worker, (db, conffile))
+    pool = start_pool(db, conffile)
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint['last_id']:
+        print 'Resuming after evaluation %d' % checkpoint['last_id']
+
+    start = time.time()
+    converted = 0
+    while True:
+        with Transaction().start(db, 0, context={}):
+            Evaluation = pool.get('gnuhealth.patient.evaluation')
+            eval_ids = map(int, Evaluation.search(
+                [('encounter', '=', None),
+                 ('id', '>', checkpoint['last_id'])],
+                order=[('id', 'ASC')], limit=window))
+        if not eval_ids:
+            break
+        chunks = [eval_ids[i:i + chunk_size]
+                  for i in range(0, len(eval_ids), chunk_size)]
+        for chunk, created, failed in workers.imap_unordered(convert_chunk,
+                                                            chunks):
+            converted += created
+            checkpoint['failed'].update(failed)
+            elapsed = time.time() - start
+            print '%d evaluations converted (%.1f/s), %d failed' % (
+                converted, converted / max(elapsed, 0.001),
+                len(checkpoint['failed']))
+        checkpoint['last_id'] = eval_ids[-1]
+        save_checkpoint(checkpoint_path, checkpoint)
+    workers.close()
+    workers.join()
+
+    print '%d Encounters created in %.1fs.' % (converted,
+                                               time.time() - start)
+    if checkpoint['failed']:
+        print 'Some evaluations failed to convert (%d)' % len(
+            checkpoint['failed'])
+        for eval_id, error in sorted(checkpoint['failed'].items()):
+            print '  %d: %s' % (eval_id, error)
+    return converted, checkpoint['failed']
+
+def _is_set(pool, Model, table, field_name):
+    '''returns a SQL condition that is true when :param field_name: of
+    the rows of :param table: holds a value, the way python truth testing
+    of the field on a record would'''
+    from sql import Column, Null
+    from sql.conditionals import Coalesce
+    from sql.operators import Exists
+    field = Model._fields[field_name]
+    column = Column(table, field_name)
+    if field._type == 'one2many':
+        target = pool.get(field.model_name).__table__()
+        return Exists(target.select(
+            target.id, where=Column(target, field.field) == table.id))
+    elif field._type == 'many2many':
+        relation = pool.get(field.relation_name).__table__()
+        return Exists(relation.select(
+            relation.id, where=Column(relation, field.origin) == table.id))
+    elif field._type == 'boolean':
+        # NULL would make the negated checks skip the row
+        return Coalesce(column, False) == True
+    elif field._type in ('char', 'text', 'selection'):
+        return (column != Null) & (column != '')
+    return (column != Null) & (column != 0)
+
+
+def verify_conversion(db, conffile, sample=SAMPLE_SIZE):
+    '''compares the evaluations with the encounters and components made
+    from them using set based queries and prints the discrepancies.
+    Returns a dict of check name => (count, sample of evaluation ids)'''
+    from sql import Literal, Null
+    from sql.aggregate import Count, Sum
+    from sql.conditionals import Case
+    from sql.operators import Exists, Not, Or
+    from trytond.transaction import Transaction
+    pool = start_pool(db, conffile)
+    results = {}
+    with Transaction().start(db, 0, context={}):
+        cursor = Transaction().cursor
+        Evaluation = pool.get('gnuhealth.patient.evaluation')
+        evaluation = Evaluation.__table__()
+        encounter = pool.get('gnuhealth.encounter').__table__()
+        converted = evaluation.join(
+            encounter, condition=evaluation.encounter == encounter.id)
+
+        def check(name, from_item, id_column, condition):
+            cursor.execute(*from_item.select(Count(Literal(1)),
+                                             where=condition))
+            count, = cursor.fetchone()
+            cursor.execute(*from_item.select(id_column, where=condition,
+                                             order_by=id_column,
+                                             limit=sample))
+            results[name] = (count, [x[0] for x in cursor.fetchall()])
+
+        check('not converted', evaluation, evaluation.id,
+              evaluation.encounter == Null)
+
+        # per patient, the evaluations should match encounters of the
+        # same patient one for one
+        matched = Sum(Case((encounter.patient == evaluation.patient, 1),
+                           else_=0))
+        per_patient = evaluation.join(
+            encounter, 'LEFT',
+            condition=evaluation.encounter == encounter.id).select(
+            evaluation.patient.as_('patient'),
+            group_by=evaluation.patient,
+            having=Count(evaluation.id) != matched)
+        check('patient counts', per_patient, per_patient.patient, None)
+
+        ev_start = evaluation.evaluation_start
+        ev_end = evaluation.evaluation_endtime
+        end_ok = (((ev_end == Null) & (encounter.end_time == Null))
+                  | ((ev_end > ev_start) & (encounter.end_time == ev_end))
+                  | ((ev_end <= ev_start)
+                     & (encounter.end_time == ev_start + DELAY)))
+        check('start/end time', converted, evaluation.id,
+              (encounter.start_time != ev_start) | Not(end_ok))
+
+        check('signer', converted, evaluation.id,
+              Not((encounter.signed_by == evaluation.signed_by)
+                  | ((encounter.signed_by == Null)
+                     & (evaluation.signed_by == Null))))
+
+        for model_name, field_names in EXPECTED_COMPONENTS:
+            component = pool.get(model_name).__table__()
+            expected = Or([_is_set(pool, Evaluation, evaluation, x)
+                           for x in field_names
+                           if x in Evaluation._fields
+                           and not hasattr(Evaluation._fields[x], 'getter')])
+            found = Exists(component.select(
+                component.id,
+                where=component.encounter == evaluation.encounter))
+            check('missing %s' % model_name, converted, evaluation.id,
+                  expected & Not(found))
+            check('unexpected %s' % model_name, converted, evaluation.id,
+                  Not(expected) & found)
+
+    problems = 0
+    for name, (count, ids) in sorted(results.items()):
+        if count:
+            problems += count
+            print '%-45s %8d  e.g. %s' % (name, count,
+                                          ', '.join(map(str, ids)))
+    if not problems:
+        print 'No discrepancies found.'
+    return results
+
+usage = """%prog [options] <config_file> <database_name>
 
 Converts Evaluations to Encounters
 
 <config_file> = full path to trytond.conf
-<database_name> = name of database to import evaluations
-"""
+<database_name> = name of database to import evaluations"""
 
 
 if __name__ == '__main__':
-    usages = usage % (sys.argv[0], )
-    if len(sys.argv) < 3:
-        print usages
-    elif sys.argv[1] in ['--help', '-h', '-?']:
-        print usages
+    parser = OptionParser(usage=usage)
+    parser.add_option('-v', '--verify', action='store_true', default=False,
+                      help='compare converted evaluations with their '
+                      'encounters and components and report discrepancies')
+    parser.add_option('-b', '--batch', action='store_true', default=False,
+                      help='convert in parallel chunks using trytond '
+                      'directly instead of proteus')
+    parser.add_option('-p', '--processes', type='int', default=None,
+                      help='number of worker processes in batch mode '
+                      '(default: number of cpus)')
+    parser.add_option('-c', '--chunk-size', type='int', default=CHUNK_SIZE,
+                      help='evaluations per transaction in batch mode '
+                      '(default: %default)')
+    parser.add_option('-w', '--window', type='int', default=WINDOW_SIZE,
+                      help='evaluations fetched per page in batch mode '
+                      '(default: %default)')
+    parser.add_option('-k', '--checkpoint', default=None,
+                      help='file where batch mode saves its progress and '
+                      'failures, and resumes from on restart')
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        parser.print_help()
     else:
-        conffile, dbname = sys.argv[1:3]
-        dbpwd = getpass('Enter admin password: ')
-        e,b = convert_remaining_evaluations(dbname, dbpwd, conffile)
+        conffile, dbname = args[:2]
+        if options.verify:
+            verify_conversion(dbname, conffile)
+        elif options.batch:
+            convert_evaluations_batch(dbname, conffile, options.processes,
+                                      options.chunk_size, options.window,
+                                      options.checkpoint)
+        else:
+            dbpwd = getpass('Enter admin password: ')
+            e,b = convert_remaining_evaluations(dbname, dbpwd, conffile)
@@ -0,0 +1,53 @@
+from trytond.model import ModelSQL
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from . import utils
+
+__all__ = ['Party', 'HealthProfessional']
+
+
+class Party(ModelSQL):
+    __name__ = 'party.party'
+
+    @classmethod
+    def write(cls, *args):
+        super(Party, cls).write(*args)
+        actions = iter(args)
+        dob_changed = []
+        for parties, values in zip(actions, actions):
+            if 'internal_user' in values or 'is_healthprof' in values:
+                utils.clear_health_professional_cache()
+            if 'dob' in values:
+                dob_changed.extend(map(int, parties))
+        if dob_changed:
+            # the age at encounter is stored so it follows the dob
+            Encounter = Pool().get('gnuhealth.encounter')
+            with Transaction().set_context(active_test=False):
+                encounters = Encounter.search([
+                    ('patient.name', 'in', dob_changed)])
+            if encounters:
+                Encounter.update_patient_age(encounters)
+
+
+class HealthProfessional(ModelSQL):
+    __name__ = 'gnuhealth.healthprofessional'
+
+    @classmethod
+    def create(cls, vlist):
+        healthprofs = super(HealthProfessional, cls).create(vlist)
+        utils.clear_health_professional_cache()
+        return healthprofs
+
+    @classmethod
+    def write(cls, *args):
+        super(HealthProfessional, cls).write(*args)
+        actions = iter(args)
+        for healthprofs, values in zip(actions, actions):
+            if 'name' in values:
+                utils.clear_health_professional_cache()
+                break
+
+    @classmethod
+    def delete(cls, healthprofs):
+        super(HealthProfessional, cls).delete(healthprofs)
+        utils.clear_health_professional_cache()
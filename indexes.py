@@ -0,0 +1,56 @@
+# Composite and partial indexes for the encounter and component tables.
+# Single column indexes come from select=True on the fields
+from trytond import backend
+from trytond.transaction import Transaction
+
+# (name suffix, columns, where clause of a partial index or None)
+ENCOUNTER_INDEXES = [
+    # patient history, newest first
+    ('patient_start_time', ['patient', 'start_time'], None),
+    # clinic queues filtered by state
+    ('institution_state_start_time', ['institution', 'state', 'start_time'],
+     None),
+    # the stale encounter job
+    ('in_progress_start_time', ['start_time'], "state = 'in_progress'"),
+]
+
+COMPONENT_INDEXES = [
+    # components of an encounter in the order they are shown
+    ('encounter_start_time', ['encounter', 'start_time'], 'active'),
+    # the unsigned component check of sign_finish
+    ('unsigned_encounter', ['encounter'], 'active AND signed_by IS NULL'),
+]
+
+
+def index_name(table_name, suffix):
+    # PostgreSQL truncates identifiers to 63 characters
+    return ('%s_%s_idx' % (table_name, suffix))[-63:]
+
+
+def create_indexes(table_name, specs):
+    '''creates the indexes in :param specs: on :param table_name: when
+    they do not exist yet. Partial indexes are only created on PostgreSQL,
+    other backends keep the single column indexes'''
+    if backend.name() != 'postgresql':
+        return
+    cursor = Transaction().cursor
+    cursor.execute('SELECT indexname FROM pg_indexes WHERE tablename = %s',
+                   (table_name,))
+    existing = set([x for x, in cursor.fetchall()])
+    for suffix, columns, where in specs:
+        name = index_name(table_name, suffix)
+        if name in existing:
+            continue
+        query = 'CREATE INDEX "%s" ON "%s" (%s)' % (
+            name, table_name, ', '.join(['"%s"' % x for x in columns]))
+        if where:
+            query += ' WHERE ' + where
+        cursor.execute(query)
+
+
+def drop_indexes(table_name, specs):
+    '''drops the indexes in :param specs: from :param table_name:'''
+    cursor = Transaction().cursor
+    for suffix, _, _ in specs:
+        cursor.execute('DROP INDEX IF EXISTS "%s"'
+                       % index_name(table_name, suffix))
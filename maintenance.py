@@ -0,0 +1,118 @@
+# Batched maintenance commands for stored encounter data
+import sys
+import time
+
+CHUNK_SIZE = 1000
+
+
+def start_pool(dbname, conffile):
+    '''loads the trytond configuration and returns the initialised pool
+    for :param dbname:'''
+    from trytond.config import config
+    config.update_etc(conffile)
+    from trytond.pool import Pool
+    Pool.start()
+    pool = Pool(dbname)
+    pool.init()
+    return pool
+
+
+def chunked_ids(Model, domain, chunk_size=CHUNK_SIZE):
+    '''yields lists of ids of :param Model: matching :param domain:,
+    paging through the table by id so that each chunk is a small query'''
+    last_id = 0
+    while True:
+        ids = map(int, Model.search(domain + [('id', '>', last_id)],
+                                    order=[('id', 'ASC')], limit=chunk_size))
+        if not ids:
+            break
+        yield ids
+        last_id = ids[-1]
+
+
+def backfill_patient_age(dbname, conffile, chunk_size=CHUNK_SIZE):
+    '''stores the age at encounter for encounters that do not have it
+    yet or whose patient had no date of birth. Each chunk is committed
+    on its own'''
+    from trytond.transaction import Transaction
+    pool = start_pool(dbname, conffile)
+    total = 0
+    start = time.time()
+    with Transaction().start(dbname, 0, context={}):
+        Encounter = pool.get('gnuhealth.encounter')
+        domain = ['OR', ('patient_age', '=', None),
+                  ('patient_age', '=', '--')]
+        for ids in chunked_ids(Encounter, [domain], chunk_size):
+            Encounter.update_patient_age(ids)
+            Transaction().cursor.commit()
+            total += len(ids)
+            print '%d encounters updated' % total
+    print 'Done in %.1fs' % (time.time() - start)
+    return total
+
+
+def backfill_signed_summary(dbname, conffile, chunk_size=CHUNK_SIZE):
+    '''stores the summary snapshot of signed encounters that were signed
+    before it was kept. Each chunk is committed on its own'''
+    from trytond.transaction import Transaction
+    pool = start_pool(dbname, conffile)
+    total = 0
+    start = time.time()
+    with Transaction().start(dbname, 0, context={}):
+        Encounter = pool.get('gnuhealth.encounter')
+        domain = [('state', '=', 'signed'), ('signed_summary', '=', None)]
+        for ids in chunked_ids(Encounter, domain, chunk_size):
+            Encounter.update_signed_summary(Encounter.browse(ids))
+            Transaction().cursor.commit()
+            total += len(ids)
+            print '%d encounters updated' % total
+    print 'Done in %.1fs' % (time.time() - start)
+    return total
+
+
+def recompute_critical_info(dbname, conffile, chunk_size=CHUNK_SIZE):
+    '''recomputes the stored critical_info of every component model.
+    Each chunk is committed on its own'''
+    from trytond.transaction import Transaction
+    pool = start_pool(dbname, conffile)
+    start = time.time()
+    changed = 0
+    with Transaction().start(dbname, 0, context={'active_test': False}):
+        EncounterComponent = pool.get('gnuhealth.encounter.component')
+        for model_name in EncounterComponent.union_models():
+            Model = pool.get(model_name)
+            total = 0
+            for ids in chunked_ids(Model, [], chunk_size):
+                changed += Model.update_critical_info(ids)
+                Transaction().cursor.commit()
+                total += len(ids)
+                print '%s: %d components checked' % (model_name, total)
+    print '%d components updated' % changed
+    print 'Done in %.1fs' % (time.time() - start)
+    return changed
+
+
+COMMANDS = {
+    'backfill-age': backfill_patient_age,
+    'backfill-summary': backfill_signed_summary,
+    'recompute-critical-info': recompute_critical_info,
+}
+
+usage = """
+%s <command> <config_file> <database_name>
+
+Runs batched maintenance on encounter data
+
+<command> = one of %s
+<config_file> = full path to trytond.conf
+<database_name> = name of database
+"""
+
+
+if __name__ == '__main__':
+    usages = usage % (sys.argv[0], ', '.join(sorted(COMMANDS)))
+    if len(sys.argv) < 4 or sys.argv[1] not in COMMANDS:
+        print usages
+    else:
+        command, conffile, dbname = sys.argv[1:4]
+        COMMANDS[command](dbname, conffile)
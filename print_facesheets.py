@@ -0,0 +1,95 @@
+# Prints the facesheets of many encounters into one document. The
+# encounters are rendered in chunks by a pool of worker processes
+import sys
+import time
+from datetime import datetime
+from multiprocessing import Pool as ProcessPool
+from optparse import OptionParser
+
+from maintenance import start_pool
+
+
+def print_facesheets(dbname, conffile, output, ids=None, institution=None,
+                     day=None, processes=None, chunk_size=None):
+    '''renders the facesheets of the encounters with :param ids: or, if
+    not given, of those started at :param institution: on :param day:
+    and writes them to :param output: as a single odt'''
+    from trytond.config import config
+    config.update_etc(conffile)
+    if processes is None:
+        processes = config.getint('health_encounter', 'facesheet_processes',
+                                  default=None)
+    # forked before trytond opens any database connection
+    workers = ProcessPool(processes)
+    try:
+        from trytond.transaction import Transaction
+        pool = start_pool(dbname, conffile)
+        from trytond.modules.health_encounter.reports import (
+            BATCH_CHUNK_SIZE, render_facesheets, combine_facesheets)
+        start = time.time()
+        with Transaction().start(dbname, 0, context={}):
+            User = pool.get('res.user')
+            Encounter = pool.get('gnuhealth.encounter')
+            EncounterReport = pool.get('gnuhealth.encounter.report',
+                                       type='report')
+            with Transaction().set_context(
+                    User.get_preferences(context_only=True)):
+                if not ids:
+                    BatchEncounters = pool.get(
+                        'gnuhealth.appointment.encounter_batch',
+                        type='wizard')
+                    day_start, day_end = BatchEncounters.get_day_bounds(day)
+                    ids = map(int, Encounter.search([
+                        ('institution', '=', institution),
+                        ('start_time', '>=', day_start),
+                        ('start_time', '<', day_end)],
+                        order=[('start_time', 'ASC')]))
+                if not ids:
+                    print 'No encounters to print'
+                    return 0
+                action_report, chunks = EncounterReport.get_facesheet_chunks(
+                    ids, {}, chunk_size or BATCH_CHUNK_SIZE)
+        # imap keeps the chunks in the order of the encounters and hands
+        # each one over as soon as it is rendered
+        documents = workers.imap(render_facesheets, chunks)
+        with open(output, 'wb') as out:
+            combine_facesheets(documents, out)
+    finally:
+        workers.close()
+        workers.join()
+    print '%d facesheets printed to %s in %.1fs' % (
+        len(ids), output, time.time() - start)
+    return len(ids)
+
+
+usage = """
+%prog [options] <config_file> <database_name> <output.odt> [<encounter_id> ...]
+
+Prints the facesheets of the encounters into a single odt document. The
+encounters are given by id or with --institution and --date
+"""
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=usage)
+    parser.add_option('-i', '--institution', type='int', default=None,
+                      help='id of the institution of the encounters')
+    parser.add_option('-d', '--date', default=None,
+                      help='day the encounters started, as YYYY-MM-DD')
+    parser.add_option('-p', '--processes', type='int', default=None,
+                      help='number of worker processes (default: '
+                      'facesheet_processes or the number of cpus)')
+    parser.add_option('-c', '--chunk-size', type='int', default=None,
+                      help='encounters rendered by a worker at a time')
+    options, args = parser.parse_args()
+    if len(args) < 3 or not (args[3:] or (options.institution
+                                          and options.date)):
+        parser.print_help()
+        sys.exit(1)
+    conffile, dbname, output = args[:3]
+    day = None
+    if options.date:
+        day = datetime.strptime(options.date, '%Y-%m-%d').date()
+    print_facesheets(dbname, conffile, output, map(int, args[3:]),
+                     options.institution, day, options.processes,
+                     options.chunk_size)
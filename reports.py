@@ -11,12 +11,273 @@
 # from datetime import datetime, timedelta
 # import pytz
 # from trytond.pyson import Eval, PYSONEncoder, Date
-# from trytond.transaction import Transaction
-# from trytond.pool import Pool
+import os
+import glob
+import hashlib
+import cPickle
+import zipfile
+import tempfile
+from io import BytesIO
+from trytond.config import config
+from trytond.transaction import Transaction
+from trytond.pool import Pool
 from trytond.report import Report
 
 __all__ = ('EncounterReport')
 
+# encounters per chunk rendered by print_facesheets.py
+BATCH_CHUNK_SIZE = config.getint('health_encounter', 'facesheet_chunk_size',
+                                 default=25)
+# size bound in MB of the rendered facesheets kept for signed encounters
+CACHE_SIZE = config.getint('health_encounter', 'facesheet_cache_size',
+                           default=256)
+OFFICE_NS = 'urn:oasis:names:tc:opendocument:xmlns:office:1.0'
+
+
+class ReportRecord(object):
+    '''plain stand in for a record in a report template. It holds only
+    the values the template uses so it can be sent to another process'''
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+
+def render_facesheets(args):
+    '''renders the odt template for a chunk of ReportRecords. Runs in a
+    worker process without a database connection'''
+    template, records, context = args
+    from relatorio.templates.opendocument import Template
+    report = Template(BytesIO(template))
+    data = report.generate(objects=records, records=records,
+                           context=context).render()
+    if hasattr(data, 'getvalue'):
+        data = data.getvalue()
+    return data
+
+
+def combine_facesheets(documents, output):
+    '''writes to the file :param output: a single odt with the body of
+    each document of the iterable :param documents: one after the other.
+    The documents are rendered from the same template so the styles of the
+    first one are used for all. The content is spooled to a temporary file
+    so only one document is held in memory at a time'''
+    from lxml import etree
+    text_path = '{%s}body/{%s}text' % (OFFICE_NS, OFFICE_NS)
+    documents = iter(documents)
+    first = zipfile.ZipFile(BytesIO(next(documents)))
+    content = etree.fromstring(first.read('content.xml'))
+    body = content.find('{%s}body' % OFFICE_NS)
+    text = content.find(text_path)
+
+    with tempfile.NamedTemporaryFile(suffix='.xml') as spool:
+        with etree.xmlfile(spool, encoding='UTF-8') as xf:
+            xf.write_declaration()
+            with xf.element(content.tag, content.attrib, nsmap=content.nsmap):
+                # office:body is the last child of the content
+                for child in content:
+                    if child is not body:
+                        xf.write(child)
+                with xf.element(body.tag, body.attrib):
+                    with xf.element(text.tag, text.attrib):
+                        for child in text:
+                            xf.write(child)
+                        for document in documents:
+                            other = etree.fromstring(zipfile.ZipFile(
+                                BytesIO(document)).read('content.xml'))
+                            for child in other.find(text_path):
+                                # declarations are only allowed at the
+                                # start of the text
+                                name = etree.QName(child).localname
+                                if not name.endswith('-decls'):
+                                    xf.write(child)
+        spool.flush()
+
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as zfile:
+            for item in first.infolist():
+                if item.filename == 'content.xml':
+                    zfile.write(spool.name, item.filename)
+                else:
+                    # keeps the mimetype entry first and uncompressed
+                    zfile.writestr(item, first.read(item.filename))
+
+
 class EncounterReport(Report):
     '''This class is used to create reports for health_encounter'''
     __name__ = 'gnuhealth.encounter.report'
+
+    @classmethod
+    def execute(cls, ids, data):
+        # signed encounters are read-only, so their facesheet can be
+        # served from the cache until something they print changes
+        cache_key = len(ids) == 1 and cls.get_cache_key(ids[0], data)
+        if cache_key:
+            cls.check_access()
+            result = cls.get_cached(cache_key)
+            if result:
+                return result
+        result = super(EncounterReport, cls).execute(ids, data)
+        if cache_key:
+            cls.set_cached(cache_key, result)
+        return result
+
+    @classmethod
+    def get_cache_key(cls, encounter_id, data):
+        '''returns the cache file name of the facesheet of a signed
+        encounter or None if the encounter is not signed. The name holds
+        a hash of the write dates of the encounter, its components, the
+        patient, institution and appointments it prints and the report
+        action and of the context values the template prints'''
+        pool = Pool()
+        Encounter = pool.get('gnuhealth.encounter')
+        EncounterComponent = pool.get('gnuhealth.encounter.component')
+        ActionReport = pool.get('ir.action.report')
+        encounter = Encounter(encounter_id)
+        if encounter.state != 'signed':
+            return None
+        if data.get('action_id') is None:
+            action_report, = ActionReport.search(
+                [('report_name', '=', cls.__name__)], limit=1)
+        else:
+            action_report = ActionReport(data['action_id'])
+
+        cursor = Transaction().cursor
+        cursor.execute(*EncounterComponent.union_select(
+            ['id', 'create_date', 'write_date'],
+            where=lambda t: t.encounter == encounter_id))
+        context = Transaction().context
+        stamps = [encounter.create_date, encounter.write_date,
+                  action_report.id, action_report.write_date,
+                  sorted(cursor.fetchall()), context.get('company'),
+                  context.get('company.rec_name'), context.get('language')]
+        institution = encounter.institution
+        related = [encounter.patient, encounter.patient.name, institution,
+                   institution and institution.name, encounter.appointment,
+                   encounter.next_appointment]
+        stamps.extend([(x.__name__, x.id, x.write_date) if x else None
+                       for x in related])
+        return '%d-%s' % (encounter_id,
+                          hashlib.sha1(repr(stamps)).hexdigest())
+
+    @staticmethod
+    def get_cache_dir():
+        path = os.path.join(config.get('database', 'path'),
+                            'health_encounter_facesheets',
+                            Transaction().cursor.database_name)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    @classmethod
+    def get_cached(cls, cache_key):
+        '''returns the cached report result for :param cache_key: or None'''
+        path = os.path.join(cls.get_cache_dir(), cache_key)
+        try:
+            with open(path, 'rb') as cached:
+                oext, content, direct_print, name = cPickle.load(cached)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return None
+        os.utime(path, None)  # mark as recently used
+        return (oext, bytearray(content), direct_print, name)
+
+    @classmethod
+    def set_cached(cls, cache_key, result):
+        '''stores a report result and evicts the least recently used
+        facesheets until the cache fits in CACHE_SIZE'''
+        cache_dir = cls.get_cache_dir()
+        encounter_id = cache_key.split('-')[0]
+        # older renderings of the same encounter can never be hit again
+        for stale in glob.glob(os.path.join(cache_dir,
+                                            '%s-*' % encounter_id)):
+            os.remove(stale)
+        oext, content, direct_print, name = result
+        path = os.path.join(cache_dir, cache_key)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as cached:
+            cPickle.dump((oext, str(content), direct_print, name), cached,
+                         cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+
+        files = []
+        for fname in os.listdir(cache_dir):
+            fpath = os.path.join(cache_dir, fname)
+            try:
+                stat = os.stat(fpath)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, fpath))
+        total = sum([x[1] for x in files])
+        for mtime, size, fpath in sorted(files):
+            if total <= CACHE_SIZE * 1024 * 1024:
+                break
+            try:
+                os.remove(fpath)
+            except OSError:
+                pass
+            total -= size
+
+    @classmethod
+    def get_facesheet_chunks(cls, ids, data, chunk_size=BATCH_CHUNK_SIZE):
+        '''returns the report action and the arguments of
+        render_facesheets for each chunk of :param chunk_size: encounters.
+        The data for all the encounters is fetched up front so that the
+        chunks can be rendered without a database connection'''
+        ActionReport = Pool().get('ir.action.report')
+        cls.check_access()
+        action_id = data.get('action_id')
+        if action_id is None:
+            action_report, = ActionReport.search(
+                [('report_name', '=', cls.__name__)], limit=1)
+        else:
+            action_report = ActionReport(action_id)
+
+        records = cls.get_facesheet_records(ids)
+        context = dict([(k, v) for k, v in Transaction().context.items()
+                        if isinstance(v, (basestring, int, long, float,
+                                          bool, type(None)))])
+        template = str(action_report.report_content)
+        chunks = [(template, records[i:i + chunk_size], context)
+                  for i in range(0, len(records), chunk_size)]
+        return action_report, chunks
+
+    @classmethod
+    def get_facesheet_records(cls, ids):
+        '''returns a ReportRecord for each encounter with the values the
+        facesheet template uses. The Function fields are read in one
+        batch and the related records are browsed together'''
+        Encounter = Pool().get('gnuhealth.encounter')
+        field_names = ['summary', 'upi', 'medical_record_num', 'sex_display',
+                       'age', 'start_time', 'end_time', 'primary_complaint']
+        if 'fvty' in Encounter._fields:
+            field_names.append('fvty')
+        values = dict([(x['id'], x) for x in Encounter.read(ids, field_names)])
+
+        def name_of(record):
+            return ReportRecord(name=record.name) if record else None
+
+        records = []
+        for encounter in Encounter.browse(ids):
+            value = values[encounter.id]
+            patient, party = encounter.patient, encounter.patient.name
+            value['patient'] = ReportRecord(
+                firstname=getattr(patient, 'firstname', party.name),
+                lastname=getattr(patient, 'lastname',
+                                 getattr(party, 'lastname', '')))
+            value['institution'] = None
+            if encounter.institution:
+                value['institution'] = ReportRecord(
+                    name=name_of(encounter.institution.name))
+            value['appointment'] = None
+            appointment = encounter.appointment
+            if appointment:
+                value['appointment'] = ReportRecord(
+                    appointment_date=appointment.appointment_date,
+                    speciality=name_of(appointment.speciality),
+                    visit_reason=name_of(getattr(appointment, 'visit_reason',
+                                                 None)))
+            value['next_appointment'] = None
+            if encounter.next_appointment:
+                value['next_appointment'] = ReportRecord(
+                    appointment_date=(
+                        encounter.next_appointment.appointment_date))
+            value.setdefault('fvty', False)
+            records.append(ReportRecord(**value))
+        return records
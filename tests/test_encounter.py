@@ -97,6 +97,30 @@ def suite():
                                         encoding='utf-8', 
                                         optionflags=doctest.REPORT_ONLY_FIRST_FAILURE,
                                         checker=None))
+    suite.addTests(doctest.DocFileSuite('test_encounter_signing.rst',
+                                        setUp=None, 
+                                        tearDown=None, 
+                                        encoding='utf-8', 
+                                        optionflags=doctest.REPORT_ONLY_FIRST_FAILURE,
+                                        checker=None))
+    suite.addTests(doctest.DocFileSuite('test_encounter_stale.rst',
+                                        setUp=None, 
+                                        tearDown=None, 
+                                        encoding='utf-8', 
+                                        optionflags=doctest.REPORT_ONLY_FIRST_FAILURE,
+                                        checker=None))
+    suite.addTests(doctest.DocFileSuite('test_encounter_batch.rst',
+                                        setUp=None, 
+                                        tearDown=None, 
+                                        encoding='utf-8', 
+                                        optionflags=doctest.REPORT_ONLY_FIRST_FAILURE,
+                                        checker=None))
+    suite.addTests(doctest.DocFileSuite('test_encounter_component_type.rst',
+                                        setUp=None, 
+                                        tearDown=None, 
+                                        encoding='utf-8', 
+                                        optionflags=doctest.REPORT_ONLY_FIRST_FAILURE,
+                                        checker=None))
     return suite
 
 if __name__ == '__main__':
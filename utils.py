@@ -1,45 +1,134 @@
 
 import pytz
 from os import path as ospath
+from trytond.cache import Cache
 from trytond.pool import Pool
-from datetime import datetime
+from trytond.transaction import Transaction
+
+# company id => timezone name ('' when the company has none). Cleared
+# when a company's timezone is changed
+_timezone_cache = Cache('health_encounter.company_timezone', context=False)
+_local_timezone = None
+# (user, company) => health professional id (0 when the user has none).
+# Cleared when the party of a user or a health professional changes
+_healthprof_cache = Cache('health_encounter.health_professional',
+                          context=False)
+# (kind, user, groups, models) => access dict of ir.model.access or
+# ir.model.field.access. Cleared when an access rule changes
+_access_cache = Cache('health_encounter.access', context=False)
+
+
+def get_local_timezone():
+    '''returns the timezone in /etc/localtime. It is read once per
+    process'''
+    global _local_timezone
+    if _local_timezone is None:
+        if not ospath.exists('/etc/localtime'):
+            raise pytz.UnknownTimeZoneError('Cannot find suitable time zone')
+        with open('/etc/localtime', 'rb') as tzfile:
+            _local_timezone = pytz.tzfile.build_tzinfo('local', tzfile)
+    return _local_timezone
 
-_cached_timezone = None
 
 def get_timezone():
     '''returns the current timezone specified for the company/facility 
     or the default which is the value in /etc/localtime'''
-    global _cached_timezone
-    if _cached_timezone:
-        return _cached_timezone
-    else:
-        try:
-            company = Transaction().context.get('company')
-            company = Pool().get('company.company')(company)
-            tz = company.get_timezone
-        except:
-            tz = None
-
-    if tz:
-        _cached_timezone = pytz.timezone(tz)
-    elif ospath.exists('/etc/localtime'):
-        _cached_timezone = pytz.tzfile.build_tzinfo('local',open('/etc/localtime', 'rb'))
-    else:
-        raise pytz.UnknownTimeZoneError('Cannot find suitable time zone')
-
-    return _cached_timezone
+    company_id = Transaction().context.get('company')
+    tzname = _timezone_cache.get(company_id)
+    if tzname is None:
+        tzname = ''
+        if company_id:
+            company = Pool().get('company.company')(company_id)
+            tzname = getattr(company, 'timezone', None) or ''
+        _timezone_cache.set(company_id, tzname)
+
+    if tzname:
+        return pytz.timezone(tzname)
+    return get_local_timezone()
+
+
+def clear_timezone_cache():
+    '''forgets the cached company timezones in every process'''
+    _timezone_cache.clear()
+
+
+def get_health_professional():
+    '''returns the id of the health professional of the current user or
+    None. The lookup is cached by user and company'''
+    transaction = Transaction()
+    key = (transaction.user, transaction.context.get('company'))
+    healthprof = _healthprof_cache.get(key)
+    if healthprof is None:
+        HealthProfessional = Pool().get('gnuhealth.healthprofessional')
+        healthprof = HealthProfessional.get_health_professional() or 0
+        _healthprof_cache.set(key, healthprof)
+    return healthprof or None
+
+
+def clear_health_professional_cache():
+    _healthprof_cache.clear()
+
+
+def localtime_many(datetimes):
+    '''returns a list of datetime objects with local timezone, looking
+    up the timezone once for the whole list. naive datetime assumed to
+    be in utc. None values are returned as None'''
+    tz = get_timezone()
+    out = []
+    for current in datetimes:
+        if current is None:
+            out.append(None)
+            continue
+        if current.tzinfo is None:
+            # assume it's utc. convert it to timezone aware
+            current = current.replace(tzinfo=pytz.UTC)
+        out.append(current.astimezone(tz))
+    return out
+
 
 def localtime(current):
     '''returns a datetime object with local timezone. naive datetime
     assumed to be in utc'''
-    tz = get_timezone()
-    if current.tzinfo is None:
-        # assume it's utc. convert it to timezone aware
-        cdt = datetime(*current.timetuple()[:6], tzinfo=pytz.UTC,
-                       microsecond=current.microsecond)
-    else:
-        cdt = current
-    return cdt.astimezone(tz)
+    return localtime_many([current])[0]
+
+
+def format_age(years, months=0, days=0):
+    '''returns the age as shown on the encounter, e.g. 34y 2m 5d.
+    Parts that are zero are left out. Returns -- if years is None'''
+    if years is None:
+        return '--'
+    parts = [(years, 'y'), (months, 'm'), (days, 'd')]
+    age = ' '.join(['%d%s' % (int(n), unit) for n, unit in parts if n])
+    return age or '0d'
+
+
+def _get_cached_access(kind, access_model, model_names):
+    User = Pool().get('res.user')
+    model_names = tuple(sorted(model_names))
+    key = (kind, Transaction().user, tuple(sorted(User.get_groups())),
+           model_names)
+    access = _access_cache.get(key)
+    if access is None:
+        access = Pool().get(access_model).get_access(list(model_names))
+        _access_cache.set(key, access)
+    return access
+
+
+def get_model_access(model_names):
+    '''returns the ir.model.access get_access dict for :param model_names:
+    cached by user and groups. The result must not be modified'''
+    return _get_cached_access('model', 'ir.model.access', model_names)
+
+
+def get_field_access(model_names):
+    '''returns the ir.model.field.access get_access dict for
+    :param model_names: cached by user and groups. The result must not be
+    modified'''
+    return _get_cached_access('field', 'ir.model.field.access', model_names)
+
+
+def clear_access_cache():
+    _access_cache.clear()
 
 
 def get_model_field_perm(model_name, field_name, perm='write',
@@ -48,8 +137,7 @@ def get_model_field_perm(model_name, field_name, perm='write',
     on :param field_name: in :param model_name: model'''
     # !! Must be run within a transaction or it nah go work
     d = 0 if default_deny else 1
-    FieldAccess = Pool().get('ir.model.field.access')
-    user_access = FieldAccess.get_access([model_name])[model_name]
+    user_access = get_field_access([model_name])[model_name]
     permdict = user_access.get(field_name, {perm: d})
     user_has_perm = bool(permdict[perm])
     return user_has_perm